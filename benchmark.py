@@ -0,0 +1,171 @@
+"""
+This script benchmarks every MFM component and the full metric functions across series lengths.
+
+Each case is timed on synthetic daily-like series (a seasonal gamma-distributed obs and a perturbed sim), with and
+without NaN values, and with ndarray or pandas Series inputs for the public functions. The components are timed
+through the kernels `model_fidelity_metric` runs: masking, NMAEp, PPF, sorting, and the SUSE and PHI histograms
+read off the sorted series. The public functions run on the NumPy backend. The import time of `mfm` is measured
+in a fresh interpreter.
+
+Results are written as JSON, and `compare` flags the cases that got slower than a previous run:
+
+    python cli.py benchmark --out bench.json
+    python cli.py benchmark --out new.json --compare bench.json
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from mfm import mfm
+from mfm_core import METRIC_VERSION, _nmaep, _sorted_histogram, _block_phase_difference
+
+SIZES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+
+class benchmark:
+    def __init__(self, sizes=SIZES, nan_fraction=0.05, min_time=0.2, max_repeats=50, seed=0):
+        self.sizes = sizes
+        self.nan_fraction = nan_fraction
+        self.min_time = min_time
+        self.max_repeats = max_repeats
+        self.seed = seed
+        # The NumPy kernels are timed, whether or not Numba is installed
+        self.mfm_temp = mfm(backend='numpy')
+
+    def series(self, n, nan=False):
+        """Synthetic sim and obs of length `n`, with a share `nan_fraction` of NaN in each when `nan`"""
+        rng = np.random.default_rng(self.seed)
+        seasonal = 1.5 + np.sin(2 * np.pi * np.arange(n) / 365.25)
+        obs = rng.gamma(0.8, 1.0, n) * seasonal
+        sim = np.abs(0.9 * np.roll(obs, 2) + rng.normal(0, 0.2, n))
+        if nan:
+            sim[rng.random(n) < self.nan_fraction] = np.nan
+            obs[rng.random(n) < self.nan_fraction] = np.nan
+        return sim, obs
+
+    def time(self, function):
+        """Best and median wall time of `function` over repeats lasting about `min_time` in total"""
+        times = []
+        start = time.perf_counter()
+        while len(times) < self.max_repeats and (not times or time.perf_counter() - start < self.min_time):
+            t = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - t)
+        return {'best_s': min(times), 'median_s': float(np.median(times)), 'repeats': len(times)}
+
+    def cases(self, n, nan):
+        """(name, input, function) of every benchmark case for one series length"""
+        import pandas as pd
+        sim, obs = self.series(n, nan)
+        sim_series, obs_series = pd.Series(sim), pd.Series(obs)
+        finite = np.isfinite(sim) & np.isfinite(obs)
+        sim_clean, obs_clean = sim[finite], obs[finite]
+        mean_obs = np.mean(obs_clean, dtype=float)
+        sim_sorted, obs_sorted = np.sort(sim_clean), np.sort(obs_clean)
+        lo, hi = min(sim_sorted[0], obs_sorted[0]), max(sim_sorted[-1], obs_sorted[-1])
+
+        def mask():
+            valid = np.isfinite(sim)
+            valid &= np.isfinite(obs)
+            return (sim, obs) if valid.all() else (sim[valid], obs[valid])
+
+        def suse():
+            _sorted_histogram(sim_sorted, lo, hi, 10)
+            _sorted_histogram(obs_sorted, lo, hi, 10)
+            _sorted_histogram(sim_sorted, sim_sorted[0], sim_sorted[-1], 10)
+            _sorted_histogram(obs_sorted, obs_sorted[0], obs_sorted[-1], 10)
+
+        def phi():
+            _sorted_histogram(sim_sorted, lo, hi, 10)
+            _sorted_histogram(obs_sorted, lo, hi, 10)
+
+        return [
+            ('mask', 'ndarray', mask),
+            ('NMAEp', 'ndarray', lambda: _nmaep(sim_clean, obs_clean, mean_obs, 1)),
+            ('PPF', 'ndarray', lambda: _block_phase_difference(sim_clean[None, :], obs_clean[None, :])),
+            ('sort', 'ndarray', lambda: (np.sort(sim_clean), np.sort(obs_clean))),
+            ('SUSE', 'ndarray', suse),
+            ('PHI', 'ndarray', phi),
+            ('model_fidelity_metric', 'ndarray', lambda: self.mfm_temp.model_fidelity_metric(sim, obs)),
+            ('model_fidelity_metric', 'Series', lambda: self.mfm_temp.model_fidelity_metric(sim_series, obs_series)),
+            ('baseline_metrics', 'ndarray', lambda: self.mfm_temp.baseline_metrics(sim, obs)),
+            ('baseline_metrics', 'Series', lambda: self.mfm_temp.baseline_metrics(sim_series, obs_series)),
+            ('model_fidelity_metric_batch', 'ndarray', lambda: self.mfm_temp.model_fidelity_metric_batch(
+                sim[None, :], obs[None, :])),
+        ]
+
+    @staticmethod
+    def import_time(module='mfm', repeats=5):
+        """Median time to import `module` in a fresh interpreter"""
+        code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [
+            os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+        times = [float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                      env=environment).stdout) for _ in range(repeats)]
+        return float(np.median(times))
+
+    def run(self, progress=True):
+        """Time every case for every size, with and without NaN values"""
+        results = []
+        for n in self.sizes:
+            for nan in [False, True]:
+                for name, kind, function in self.cases(n, nan):
+                    results.append({'name': name, 'n': n, 'nan': nan, 'input': kind, **self.time(function)})
+                    if progress:
+                        print(f"{name:>27} {kind:>7} n={n:<9} nan={nan!s:<5} {results[-1]['best_s'] * 1e3:10.3f} ms")
+
+        return {
+            'commit': self._commit(),
+            'metric_version': METRIC_VERSION,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'import_time_s': {'mfm': self.import_time('mfm'), 'mfm_core': self.import_time('mfm_core')},
+            'results': results,
+        }
+
+    @staticmethod
+    def _commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def write_result(result, path):
+        print(f'\033[1;31mSaving {path}...\033[0m')
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=1)
+        print('\033[1;31mDone.\033[0m')
+
+        return 0
+
+    @staticmethod
+    def compare(baseline, current, threshold=1.2):
+        """Cases (and import times) whose best time grew by more than `threshold` times from `baseline`
+
+        Both arguments are benchmark results or paths to their JSON files. Returns a list of
+        (case, baseline seconds, current seconds, ratio), slowest regression first.
+        """
+        def load(result):
+            if isinstance(result, str):
+                with open(result) as f:
+                    return json.load(f)
+            return result
+
+        baseline, current = load(baseline), load(current)
+        old = {(r['name'], r['n'], r['nan'], r['input']): r['best_s'] for r in baseline['results']}
+        new = {(r['name'], r['n'], r['nan'], r['input']): r['best_s'] for r in current['results']}
+        for module, seconds in current.get('import_time_s', {}).items():
+            if module in baseline.get('import_time_s', {}):
+                old[('import', module)] = baseline['import_time_s'][module]
+                new[('import', module)] = seconds
+
+        regressions = [(case, old[case], new[case], new[case] / old[case]) for case in new
+                       if case in old and new[case] > threshold * old[case]]
+        return sorted(regressions, key=lambda regression: -regression[3])
@@ -2,71 +2,61 @@
 This script plots the figure of the Case 1: Error compensation.
 """
 
+import numpy as np
+import matplotlib.pyplot as plt
 from mfm import *
 from read_file import *
+from figures import FIGURE_FORMATS, save_figure
+from experiment import experiment, bias
+from case_data import case_data, file_stamp
 
 class case_1_error_compensation():
-    def __init__(self, scale=50, write=False, reader=read_file(), mfm_temp=mfm()):
+    def __init__(self, scale=50, write=False, reader=read_file(), mfm_temp=mfm(), data=case_data(),
+                 formats=FIGURE_FORMATS):
         self.scale = scale
         self.write = write
         self.reader = reader
         self.mfm_temp = mfm_temp
+        self.data = data
+        self.formats = formats
 
 
     def error_compensation_data(self):
         """Generating the error compensation data."""
 
         file = 'data/01013500_05_model_output.txt'
-        flow_data = self.reader.read_flow(file)
-        # sim = flow_data['sim'].copy()
-        obs = flow_data['obs'].copy()
-        obs_double = np.concatenate([obs, obs]).copy()
-
-        categories = ['high_low', 'high_good']
-        metrics = ['mfm', 'nse', 'kge', 'mkge', 'rmse', 'nrmse', 'alpha', 'beta']
-        result = {
-            category: {metric: np.zeros(self.scale) for metric in metrics}
-            for category in categories
-        }
-
-        for j in range(self.scale):
-            k = j + 1
-            n = len(obs)
 
-            sim_high_low = obs_double.copy()
-            sim_high_low[:n] *= (k + 1) / k
-            sim_high_low[n:] *= (k - 1) / k
-
-            sim_high_good = obs_double.copy()
-            sim_high_good[:n] *= (k + 1) / k
-
-            result['high_low']['mfm'][j] = self.mfm_temp.model_fidelity_metric(sim=sim_high_low, obs=obs_double)['MFM']
-            result_standard_metrcs = self.mfm_temp.baseline_metrics(sim=sim_high_low, obs=obs_double)
-            result['high_low']['nse'][j] = result_standard_metrcs['NSE']
-            result['high_low']['kge'][j] = result_standard_metrcs['KGE']
-            result['high_low']['mkge'][j] = result_standard_metrcs['mKGE']
-            result['high_low']['rmse'][j] = result_standard_metrcs['RMSE']
-            result['high_low']['nrmse'][j] = result_standard_metrcs['NRMSE']
-            result['high_low']['alpha'][j] = result_standard_metrcs['alpha']
-            result['high_low']['beta'][j] = result_standard_metrcs['beta']
-
-            result['high_good']['mfm'][j] = self.mfm_temp.model_fidelity_metric(sim=sim_high_good, obs=obs_double)['MFM']
-            result_standard_metrcs = self.mfm_temp.baseline_metrics(sim=sim_high_good, obs=obs_double)
-            result['high_good']['nse'][j] = result_standard_metrcs['NSE']
-            result['high_good']['kge'][j] = result_standard_metrcs['KGE']
-            result['high_good']['mkge'][j] = result_standard_metrcs['mKGE']
-            result['high_good']['rmse'][j] = result_standard_metrcs['RMSE']
-            result['high_good']['nrmse'][j] = result_standard_metrcs['NRMSE']
-            result['high_good']['alpha'][j] = result_standard_metrcs['alpha']
-            result['high_good']['beta'][j] = result_standard_metrcs['beta']
-
-        return result
+        def compute():
+            flow_data = self.data.flow(self.reader, file)
+            # sim = flow_data['sim'].copy()
+            obs = flow_data['obs'].copy()
+            obs_double = np.concatenate([obs, obs]).copy()
+
+            n = len(obs)
+            k = np.arange(1, self.scale + 1)
+
+            # Both perturbation families are scored as batches of the scale levels
+            engine = experiment(backend=self.mfm_temp.backend)
+            families = {
+                'high_low': [bias((k + 1) / k, stop=n), bias((k - 1) / k, start=n)],
+                'high_good': bias((k + 1) / k, stop=n),
+            }
+            metrics = {'mfm': 'MFM', 'nse': 'NSE', 'kge': 'KGE', 'mkge': 'mKGE', 'rmse': 'RMSE', 'nrmse': 'NRMSE',
+                       'alpha': 'alpha', 'beta': 'beta'}
+            result = {}
+            for category, perturbation in families.items():
+                values = engine.run_array(obs_double, obs_double, sim_perturbation=perturbation)[0]
+                result[category] = {metric: values[:, engine.components.index(name)]
+                                    for metric, name in metrics.items()}
+
+            return result
+
+        return self.data.get('case_1_error_compensation', (file_stamp(file), self.scale), compute)
 
     def plot_sensitivity(self):
         """Plot error compensation sensitivity curve."""
 
-        result_temp = case_1_error_compensation()
-        result = result_temp.error_compensation_data()
+        result = self.error_compensation_data()
 
         mfm_diff = result['high_good']['mfm'] - result['high_low']['mfm']
         nse_diff = result['high_good']['nse'] - result['high_low']['nse']
@@ -92,10 +82,7 @@ class case_1_error_compensation():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_1_sensitivity...\033[0m')
-            plt.savefig("temp/case_1_sensitivity.png", bbox_inches='tight', dpi=300)
-            plt.savefig("temp/case_1_sensitivity.pdf", bbox_inches='tight', dpi=300)
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_1_sensitivity', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -105,8 +92,7 @@ class case_1_error_compensation():
     def plot_error_compensation(self):
         """Plot error compensation figure."""
 
-        result_temp = case_1_error_compensation()
-        result = result_temp.error_compensation_data()
+        result = self.error_compensation_data()
 
         metrics = ['MFM', 'NSE', 'KGE', 'mKGE', 'RMSE', 'NRMSE', 'alpha', 'beta']
         metrics_left = metrics[0:4]
@@ -193,10 +179,7 @@ class case_1_error_compensation():
 
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_1_error_compensation...\033[0m')
-            plt.savefig("temp/case_1_error_compensation.png", dpi=300, bbox_inches='tight')
-            plt.savefig("temp/case_1_error_compensation.pdf", dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone\033[0m')
+            save_figure('case_1_error_compensation', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
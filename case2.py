@@ -2,14 +2,21 @@
 This script plots the figure of the Case 2: Low variability.
 """
 
+import numpy as np
+import matplotlib.pyplot as plt
 from mfm import *
 from read_file import *
+from figures import FIGURE_FORMATS, save_figure
+from experiment import experiment, outlier
+from case_data import case_data
 
 class case_2_low_variability():
-    def __init__(self, scale=51, write=False, mfm_temp=mfm()):
+    def __init__(self, scale=51, write=False, mfm_temp=mfm(), data=case_data(), formats=FIGURE_FORMATS):
         self.scale = scale
         self.write = write
         self.mfm_temp = mfm_temp
+        self.data = data
+        self.formats = formats
 
     def low_variability(self):
         """Show the reliability of metrics in low variability case."""
@@ -74,10 +81,7 @@ class case_2_low_variability():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_2_outlier...\033[0m')
-            plt.savefig("temp/case_2_outlier.png", bbox_inches='tight', dpi=300)
-            plt.savefig("temp/case_2_outlier.pdf", bbox_inches='tight', dpi=300)
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_2_outlier', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -92,39 +96,24 @@ class case_2_low_variability():
         t_pi = t * np.pi
         cost = np.cos(t_pi)
 
-        categories = ['anti_phase', 'in_phase']
-        metrics = ['mfm', 'nse', 'kge', 'mkge', 'rmse', 'nrmse']
-        result = {
-            category: {metric: np.zeros(self.scale) for metric in metrics}
-            for category in categories
+        # Outliers at the last time step, one level per scaling step, scored as batches
+        i = np.arange(self.scale)
+        engine = experiment(p=1, phase=True, backend=self.mfm_temp.backend)
+        families = {
+            'anti_phase': (outlier(1.01 + i / 100), outlier(0.99 - i / 100)),
+            'in_phase': (outlier(1.01 + i / 100), outlier(1.03 + i / 100)),
         }
+        metrics = {'mfm': 'MFM', 'nse': 'NSE', 'kge': 'KGE', 'mkge': 'mKGE', 'rmse': 'RMSE', 'nrmse': 'NRMSE'}
 
-        for i in range(self.scale):
-            obs_anti_phase = np.abs(cost)
-            sim_anti_phase = np.abs(cost)
-            obs_anti_phase[len(t) - 1] = 0.99 - i / 100
-            sim_anti_phase[len(t) - 1] = 1.01 + i / 100
-
-            obs_in_phase = np.abs(cost)
-            sim_in_phase = np.abs(cost)
-            obs_in_phase[len(t) - 1] = 1.03 + i / 100
-            sim_in_phase[len(t) - 1] = 1.01 + i / 100
-
-            result['anti_phase']['mfm'][i] = self.mfm_temp.model_fidelity_metric(sim_anti_phase, obs_anti_phase, phase=True)['MFM']
-            result_standard_metrcs = self.mfm_temp.baseline_metrics(sim_anti_phase, obs_anti_phase)
-            result['anti_phase']['nse'][i] = result_standard_metrcs['NSE']
-            result['anti_phase']['kge'][i] = result_standard_metrcs['KGE']
-            result['anti_phase']['mkge'][i] = result_standard_metrcs['mKGE']
-            result['anti_phase']['rmse'][i] = result_standard_metrcs['RMSE']
-            result['anti_phase']['nrmse'][i] = result_standard_metrcs['NRMSE']
-
-            result['in_phase']['mfm'][i] = self.mfm_temp.model_fidelity_metric(sim_in_phase, obs_in_phase, p=1, phase=True)['MFM']
-            result_standard_metrcs = self.mfm_temp.baseline_metrics(sim_in_phase, obs_in_phase)
-            result['in_phase']['nse'][i] = result_standard_metrcs['NSE']
-            result['in_phase']['kge'][i] = result_standard_metrcs['KGE']
-            result['in_phase']['mkge'][i] = result_standard_metrcs['mKGE']
-            result['in_phase']['rmse'][i] = result_standard_metrcs['RMSE']
-            result['in_phase']['nrmse'][i] = result_standard_metrcs['NRMSE']
+        def compute():
+            result = {}
+            for category, (sim_perturbation, obs_perturbation) in families.items():
+                values = engine.run_array(np.abs(cost), np.abs(cost), sim_perturbation, obs_perturbation)[0]
+                result[category] = {metric: values[:, engine.components.index(name)]
+                                    for metric, name in metrics.items()}
+            return result
+
+        result = self.data.get('case_2_sensitivity', (self.scale,), compute)
 
         # print(result)
         
@@ -166,10 +155,7 @@ class case_2_low_variability():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_2_sensitivity...\033[0m')
-            plt.savefig("temp/case_2_sensitivity.png", bbox_inches='tight', dpi=300)
-            plt.savefig("temp/case_2_sensitivity.pdf", bbox_inches='tight', dpi=300)
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_2_sensitivity', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
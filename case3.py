@@ -2,15 +2,22 @@
 This script represents how phase affects the standard metrics.
 """
 
+import numpy as np
+import matplotlib.pyplot as plt
 from mfm import *
 from read_file import *
+from figures import FIGURE_FORMATS, save_figure
+from experiment import experiment, bias
+from case_data import case_data
 from matplotlib.patches import ConnectionPatch
 
 class case_3_phase_error():
-    def __init__(self, scale=50, write=False, mfm_temp = mfm()):
+    def __init__(self, scale=50, write=False, mfm_temp = mfm(), data=case_data(), formats=FIGURE_FORMATS):
         self.scale = scale
         self.write = write
         self.mfm_temp = mfm_temp
+        self.data = data
+        self.formats = formats
 
     def geometry(self):
         """Plot the phase-corrected error."""
@@ -103,10 +110,7 @@ class case_3_phase_error():
 
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_3_geometry...\033[0m')
-            plt.savefig("temp/case_3_geometry.png", dpi=300, bbox_inches='tight')
-            plt.savefig("temp/case_3_geometry.pdf", dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_3_geometry', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
 
@@ -184,10 +188,7 @@ class case_3_phase_error():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_3_decoupling...\033[0m')
-            plt.savefig("temp/case_3_decoupling.png", dpi=300, bbox_inches='tight')  # 保存为高分辨率png
-            plt.savefig("temp/case_3_decoupling.pdf", dpi=300, bbox_inches='tight')  # 保存为高分辨率png
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_3_decoupling', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -197,24 +198,20 @@ class case_3_phase_error():
     def sensitivity(self):
         """Plot phase sensitivity figure."""
 
-        metrics = ['mfm', 'nse', 'kge', 'mkge', 'rmse', 'nrmse']
-        result = {metric: np.zeros(self.scale) for metric in metrics}
-
-        for i in range(self.scale):
-            t = np.arange(0, 100)
-            t_pi = t * np.pi
-            cost = np.cos(t_pi)
-            
-            obs_sensitivity = cost / (i + 1) + 1
-            sim_sensitivity = - cost / (i + 1) + 1
-
-            result['mfm'][i] = self.mfm_temp.model_fidelity_metric(sim_sensitivity, obs_sensitivity)['MFM']
-            std_m = self.mfm_temp.baseline_metrics(sim_sensitivity, obs_sensitivity)
-            result['nse'][i] = std_m['NSE']
-            result['kge'][i] = std_m['KGE']
-            result['mkge'][i] = std_m['mKGE']
-            result['rmse'][i] = std_m['RMSE']
-            result['nrmse'][i] = std_m['NRMSE']
+        t = np.arange(0, 100)
+        t_pi = t * np.pi
+        cost = np.cos(t_pi)
+
+        # Amplitudes 1 / (i + 1) around 1, as a bias family centered on 1, scored as one batch
+        amplitude = bias(1 / np.arange(1, self.scale + 1), center=1.0)
+        engine = experiment(backend=self.mfm_temp.backend)
+        metrics = {'mfm': 'MFM', 'nse': 'NSE', 'kge': 'KGE', 'mkge': 'mKGE', 'rmse': 'RMSE', 'nrmse': 'NRMSE'}
+
+        def compute():
+            values = engine.run_array(- cost + 1, cost + 1, amplitude, amplitude)[0]
+            return {metric: values[:, engine.components.index(name)] for metric, name in metrics.items()}
+
+        result = self.data.get('case_3_sensitivity', (self.scale,), compute)
 
         plt.figure(figsize=(8, 3.5))
         plt.plot()
@@ -238,10 +235,7 @@ class case_3_phase_error():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_3_sensitivity...\033[0m')
-            plt.savefig("temp/case_3_sensitivity.png", bbox_inches='tight', dpi=300)
-            plt.savefig("temp/case_3_sensitivity.pdf", bbox_inches='tight', dpi=300)
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_3_sensitivity', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -2,20 +2,57 @@
 This script tests MFM in CAMELS dataset.
 """
 
+import numpy as np
+import matplotlib.pyplot as plt
 from mfm import *
 from read_file import *
+from figures import FIGURE_FORMATS, save_figure
+from case_data import case_data, file_stamp
+
+# Cartopy features of the maps, projected once per (projection, extent) and shared by every panel
+_MAP_FEATURES = {}
+
+
+def _map_features(map_projection, extent):
+    """COASTLINE, BORDERS and STATES around the lon/lat `extent`, projected once into `map_projection`"""
+    import cartopy.feature as cfeature
+
+    key = (map_projection.proj4_init, tuple(extent))
+    if key not in _MAP_FEATURES:
+        # A margin keeps the lines that cross the edge of the panels
+        x0, x1, y0, y1 = extent
+        margin = (x0 - 10, x1 + 10, y0 - 10, y1 + 10)
+        features = []
+        for feature in [cfeature.COASTLINE, cfeature.BORDERS, cfeature.STATES]:
+            geometries = [map_projection.project_geometry(geometry, feature.crs)
+                          for geometry in feature.intersecting_geometries(margin)]
+            features.append(cfeature.ShapelyFeature([geometry for geometry in geometries if not geometry.is_empty],
+                                                    map_projection, **feature.kwargs))
+        _MAP_FEATURES[key] = features
+    return _MAP_FEATURES[key]
 
 class case_4_real_world_data():
-    def __init__(self, write=False, reader=read_file(), mfm_temp=mfm()):
+    def __init__(self, write=False, reader=read_file(), mfm_temp=mfm(), data=case_data(), formats=FIGURE_FORMATS):
         self.write = write
         self.reader = reader
         self.mfm_temp = mfm_temp
+        self.data = data
+        self.formats = formats
+
+    def gauge_mfm(self, file):
+        """MFM of the model output of one gauge, computed once per file version."""
+
+        def compute():
+            flow = self.data.flow(self.reader, file)
+            return self.mfm_temp.model_fidelity_metric(flow['sim'], flow['obs'])
+
+        return self.data.get('gauge_mfm', (file_stamp(file),), compute)
 
     def two_examples(self):
         """Show two examples in CAMELS dataset."""
         
-        flow_near_constant = self.reader.read_flow('data/05120500_05_model_output.txt')
-        flow_phase = self.reader.read_flow('data/06409000_05_model_output.txt')
+        flow_near_constant = self.data.flow(self.reader, 'data/05120500_05_model_output.txt')
+        flow_phase = self.data.flow(self.reader, 'data/06409000_05_model_output.txt')
 
         fig, [ax1, ax2] = plt.subplots(2, 1, figsize=(8, 4.5))
         ax1.plot(flow_near_constant['sim'], color='#4477AA', alpha=0.8, linestyle='--', label='Simulation', lw=1.5,
@@ -40,10 +77,7 @@ class case_4_real_world_data():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_4_flow...\033[0m')
-            plt.savefig('temp/case_4_flow.png', dpi=300, bbox_inches='tight')
-            plt.savefig('temp/case_4_flow.pdf', dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_4_flow', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -53,14 +87,12 @@ class case_4_real_world_data():
     def radar(self):
         """Plot radar plot of these examples."""
         
-        flow_05120500 = self.reader.read_flow('data/05120500_05_model_output.txt')
-        mfm_05120500 = self.mfm_temp.model_fidelity_metric(flow_05120500['sim'], flow_05120500['obs'])
+        mfm_05120500 = self.gauge_mfm('data/05120500_05_model_output.txt')
         print('\033[1;31mMFM of site 05120500\033[0m')
         print(mfm_05120500)
         print("========================")
 
-        flow_06409000 = self.reader.read_flow('data/06409000_05_model_output.txt')
-        mfm_06409000 = self.mfm_temp.model_fidelity_metric(flow_06409000['sim'], flow_06409000['obs'])
+        mfm_06409000 = self.gauge_mfm('data/06409000_05_model_output.txt')
         print('\033[1;31mMFM of site 06409000\033[0m')
         print(mfm_06409000)
 
@@ -94,10 +126,7 @@ class case_4_real_world_data():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_4_radar...\033[0m')
-            plt.savefig("temp/case_4_radar.png", dpi=300, bbox_inches='tight')
-            plt.savefig("temp/case_4_radar.pdf", dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_4_radar', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -110,7 +139,6 @@ class case_4_real_world_data():
         import matplotlib.colors as mcolors
         import matplotlib.gridspec as gridspec  # Import gridspec
         import cartopy.crs as ccrs
-        import cartopy.feature as cfeature
         
         plt.rcParams['font.family'] = 'serif'
         plt.rcParams['font.serif'] = 'Times New Roman'
@@ -130,8 +158,12 @@ class case_4_real_world_data():
 
         batlow_cmap = mcolors.LinearSegmentedColormap.from_list("batlow", batlow_colors)
 
-        df_gof = self.reader.read_result('data/case_4_mfm.txt')
-        df_all = df_gof[['lat', 'lon', 'GOF_stat', 'score']]
+        df_all = self.data.get('result_table', (file_stamp('data/case_4_mfm.txt'),),
+                               lambda: self.reader.read_result('data/case_4_mfm.txt',
+                                                               columns=['lat', 'lon', 'GOF_stat', 'score']),
+                               persist=False)
+        # Rows of each metric, split once for the maps and the histograms
+        df_by_stat = {stat: df_stat for stat, df_stat in df_all.groupby('GOF_stat', sort=False, observed=True)}
         gof_stats = ['MFM', 'KGE', 'RMSE', 'NSE', 'mKGE', 'NRMSE']
 
         vmin = 0
@@ -139,6 +171,8 @@ class case_4_real_world_data():
 
         map_projection = ccrs.LambertConformal(central_longitude=-96.0, central_latitude=39.0)
         data_projection = ccrs.PlateCarree()
+        extent = [-125, -66.5, 24, 50]
+        coastline, borders, states = _map_features(map_projection, extent)
 
         fig = plt.figure(figsize=(8, 5.5))
 
@@ -164,13 +198,13 @@ class case_4_real_world_data():
         numbering = ['(a)', '(b)', '(c)', '(d)', '(e)', '(f)']
 
         for i, (ax, stat) in enumerate(zip(map_axes, gof_stats)):
-            df_stat = df_all[df_all['GOF_stat'] == stat]
+            df_stat = df_by_stat[stat]
 
-            ax.add_feature(cfeature.COASTLINE, lw=1, zorder=2)
-            ax.add_feature(cfeature.BORDERS, linestyle='-', lw=0.8, zorder=2)
-            ax.add_feature(cfeature.STATES, linestyle='--', alpha=0.3, lw=0.5, zorder=1)
+            ax.add_feature(coastline, lw=1, zorder=2)
+            ax.add_feature(borders, linestyle='-', lw=0.8, zorder=2)
+            ax.add_feature(states, linestyle='--', alpha=0.3, lw=0.5, zorder=1)
 
-            ax.set_extent([-125, -66.5, 24, 50], crs=data_projection)
+            ax.set_extent(extent, crs=data_projection)
 
             # Create the scatter plot
             sc = ax.scatter(
@@ -225,7 +259,7 @@ class case_4_real_world_data():
         bins = np.linspace(0, 1, 25)
 
         for stat in gof_stats:
-            scores = df_all[df_all['GOF_stat'] == stat]['score']
+            scores = df_by_stat[stat]['score']
             print(f"{stat} range = [{np.min(scores)}, {np.max(scores)}]")
 
             hist_ax.hist(scores.clip(0, 1),
@@ -256,10 +290,7 @@ class case_4_real_world_data():
         
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_4_spatial_distribution...\033[0m')
-            plt.savefig('temp/case_4_spatial_distribution.png', dpi=300, bbox_inches='tight')
-            plt.savefig('temp/case_4_spatial_distribution.pdf', dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_4_spatial_distribution', self.formats)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -2,12 +2,16 @@
 This script plots the hyperparameter sensitivity of MFM.
 """
 
+import numpy as np
+import matplotlib.pyplot as plt
 from mfm import *
 from read_file import *
+from figures import FIGURE_FORMATS, save_figure
 
 class case_5_sensitivity():
-    def __init__(self, write=False):
+    def __init__(self, write=False, formats=FIGURE_FORMATS):
         self.write = write
+        self.formats = formats
 
     def sensitivity(self):
         """Plot the sensitivity of MFM"""
@@ -103,10 +107,7 @@ class case_5_sensitivity():
 
         # Save figure
         if self.write:
-            print('\033[1;31mSaving case_5_sensitivity...\033[0m')
-            fig.savefig("temp/case_5_sensitivity.png", dpi=300, bbox_inches='tight')
-            fig.savefig("temp/case_5_sensitivity.pdf", dpi=300, bbox_inches='tight')
-            print('\033[1;31mDone.\033[0m')
+            save_figure('case_5_sensitivity', self.formats, fig)
         else:
             print('\033[1;31mFigure will not be saved.\033[0m')
         plt.show()
@@ -0,0 +1,73 @@
+"""
+This script is the shared, lazily computed data layer of the case studies.
+
+Each dataset (a flow table, a perturbation experiment, the metrics of a gauge) is computed on first use and
+kept in memory under its name and parameters, so every figure of a case reuses it. Inputs read from files are
+keyed by their path, size and modification time, and computed results by `METRIC_VERSION` as well. With a
+`directory`, results are also pickled there and survive the process; flow tables are not, as `read_file`
+already caches them in its .npz sidecars.
+
+    data = case_data()                              # memory only, shared by the case classes
+    data = case_data(directory='temp/case_data')    # plus on-disk persistence
+
+Returned datasets are shared between callers and must not be modified in place.
+"""
+
+import hashlib
+import os
+import pickle
+import numpy as np
+from mfm_core import METRIC_VERSION
+
+
+def file_stamp(file_path):
+    """(path, size, modification time) of a file, so a dataset is recomputed when its input file changes"""
+    stat = os.stat(file_path)
+    return file_path, stat.st_size, stat.st_mtime_ns
+
+
+class case_data:
+    def __init__(self, directory=None):
+        """`directory` enables on-disk persistence of the computed datasets"""
+        self.directory = directory
+        self._memory = {}
+
+    def _path(self, name, params):
+        digest = hashlib.blake2b(repr((name, METRIC_VERSION, params)).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f'{name}-{digest}.pkl')
+
+    def get(self, name, params, compute, persist=True):
+        """The dataset `name` for the hyperparameters `params` (a tuple), from compute() the first time"""
+        key = (name, tuple(params))
+        if key in self._memory:
+            return self._memory[key]
+
+        path = self._path(*key) if self.directory is not None and persist else None
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        else:
+            value = compute()
+            if path is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                # A temporary file per process, so concurrent writers never share one before the rename
+                temp_path = f'{path}.{os.getpid()}.tmp'
+                try:
+                    with open(temp_path, 'wb') as f:
+                        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(temp_path, path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+
+        self._memory[key] = value
+        return value
+
+    def flow(self, reader, file_path):
+        """`reader.read_flow(file_path)`, read once per file version"""
+        return self.get('flow', (file_stamp(file_path), np.dtype(reader.dtype).str),
+                        lambda: reader.read_flow(file_path), persist=False)
+
+    def clear(self):
+        """Drop the in-memory datasets (the persisted ones are kept)"""
+        self._memory.clear()
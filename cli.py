@@ -0,0 +1,255 @@
+"""
+This script is the command-line entry point for scoring a directory of CAMELS model outputs.
+
+    python cli.py evaluate <dir> --metrics MFM,NSE,KGE --workers 4 --out results.store
+    python cli.py benchmark --out bench.json --compare previous.json
+    python cli.py parity
+
+<dir> is either a directory of <gauge>_05_model_output.txt files or a store written by
+`read_file.read_directory`. Sites are scheduled in chunks across a process pool, and every finished chunk is
+appended to a checkpoint next to the output, so a killed job resumes where it stopped. The output is long-format
+with the columns of data/case_4_mfm.txt (one row per site and metric); the uncertainty columns are filled when
+--n-boot is given and left empty otherwise. A .store output is a columnar `result_store`.
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from read_file import read_file, MODEL_OUTPUT_PATTERN
+from result_store import result_store
+from uncertainty import uncertainty, water_years, GOF_STATS, RESULT_COLUMNS
+
+
+def _chunk_task(args):
+    """Process-pool entry point: result rows of one chunk of sites"""
+    engine, sites = args
+    return engine.score_sites(sites)
+
+
+class evaluator:
+    def __init__(self, metrics=GOF_STATS, n_boot=0, seed=0, chunk_size=16):
+        """`n_boot` > 0 adds the jackknife and bootstrap statistics of `uncertainty` to every row"""
+        unknown = [metric for metric in metrics if metric not in GOF_STATS]
+        if unknown:
+            raise ValueError(f'Unknown metrics {unknown}, expected a subset of {GOF_STATS}')
+        self.metrics = list(metrics)
+        self.n_boot = n_boot
+        self.chunk_size = chunk_size
+        self.engine = uncertainty(n_boot=max(n_boot, 1), seed=seed)
+        # First line of a checkpoint, so a run only resumes rows scored with the same settings
+        self.settings = f'# n_boot={n_boot} seed={seed}'
+
+    def discover(self, directory):
+        """(gauge, (position, path)) pairs of a model output directory or a memory-mapped store, sorted by gauge ID
+
+        The position of a gauge in the sorted list seeds its bootstrap stream, so resuming does not change it.
+        """
+        if os.path.exists(os.path.join(directory, 'gauge.npy')):
+            gauges = read_file().open_store(directory)['gauge']
+            sites = [(gauge, (i, directory)) for i, gauge in enumerate(gauges)]
+        else:
+            names = sorted(name for name in os.listdir(directory) if MODEL_OUTPUT_PATTERN.match(name))
+            sites = [(MODEL_OUTPUT_PATTERN.match(name).group(1), (i, os.path.join(directory, name)))
+                     for i, name in enumerate(names)]
+        if not sites:
+            raise FileNotFoundError(f'No *_05_model_output.txt files or store in {directory}')
+        return sites
+
+    @staticmethod
+    def _load(source):
+        """Dates (year, month), sim and obs of one site"""
+        i, path = source
+        if os.path.isdir(path):
+            store = read_file().open_store(path)
+            dates = store['date']
+            sim, obs = np.asarray(store['sim'][i]), np.asarray(store['obs'][i])
+            return dates.year.to_numpy(), dates.month.to_numpy(), sim, obs
+        flow = read_file().read_flow(path)
+        return flow['year'].to_numpy(), flow['month'].to_numpy(), flow['sim'].to_numpy(), flow['obs'].to_numpy()
+
+    def score_sites(self, sites):
+        """Long-format result rows of `sites`, a list of (gauge, source) pairs"""
+        loaded = [self._load(source) for _, source in sites]
+        if self.n_boot > 0:
+            tables = [self.engine.site_statistics(sim, obs, water_years(year, month),
+                                                  np.random.SeedSequence(self.engine.seed, spawn_key=(source[0],)))
+                      for (year, month, sim, obs), (_, source) in zip(loaded, sites)]
+        else:
+            # Sites of a chunk are scored together; NaN padding is masked like missing data
+            length = max(len(sim) for _, _, sim, _ in loaded)
+            sim = np.full((len(loaded), length), np.nan)
+            obs = np.full((len(loaded), length), np.nan)
+            for row, (_, _, site_sim, site_obs) in enumerate(loaded):
+                sim[row, :len(site_sim)] = site_sim
+                obs[row, :len(site_obs)] = site_obs
+            scores, cor = self.engine.scores(sim, obs)
+            tables = [pd.DataFrame({'score': scores[row], 'cor': cor[row]}, index=pd.Index(GOF_STATS, name='GOF_stat'))
+                      for row in range(len(loaded))]
+
+        result = pd.concat([table.loc[self.metrics].reset_index().assign(CAMELS_site=int(gauge))
+                            for table, (gauge, _) in zip(tables, sites)], ignore_index=True)
+        return result.reindex(columns=RESULT_COLUMNS)
+
+    def run(self, directory, out, workers=1, coords=None, progress=True):
+        """Score every site of `directory` and write the long-format table to `out`
+
+        Finished chunks are appended to `<out>.checkpoint`; sites already there are skipped, and the
+        checkpoint is removed once `out` is written. A checkpoint written with another n_boot or seed is
+        refused rather than mixed into the output. `coords` is a table with CAMELS_site, lat and lon columns
+        (e.g. data/case_4_mfm.txt) used to fill the coordinates.
+        """
+        sites = self.discover(directory)
+        checkpoint = f'{out}.checkpoint'
+        done = self._read_checkpoint(checkpoint)
+        pending = [site for site in sites if int(site[0]) not in done]
+        chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+
+        with tqdm(total=len(sites), initial=len(sites) - len(pending), unit='site', disable=not progress) as bar:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = {pool.submit(_chunk_task, (self, chunk)): len(chunk) for chunk in chunks}
+                    for future in as_completed(futures):
+                        self._append_checkpoint(checkpoint, future.result())
+                        bar.update(futures[future])
+            else:
+                for chunk in chunks:
+                    self._append_checkpoint(checkpoint, self.score_sites(chunk))
+                    bar.update(len(chunk))
+
+        result = pd.read_csv(checkpoint, sep='\t', header=0, skiprows=1)
+        order = {int(gauge): i for i, (gauge, _) in enumerate(sites)}
+        result = result[result['CAMELS_site'].isin(order)]
+        result = result.assign(site_order=result['CAMELS_site'].map(order),
+                               stat_order=result['GOF_stat'].map(self.metrics.index))
+        result = result.sort_values(['site_order', 'stat_order'])[RESULT_COLUMNS].reset_index(drop=True)
+        if coords is not None:
+            table = read_file().read_result(coords)[['CAMELS_site', 'lat', 'lon']]
+            table = table.assign(CAMELS_site=table['CAMELS_site'].astype(int)).drop_duplicates('CAMELS_site')
+            location = table.set_index('CAMELS_site')
+            result['lat'] = result['CAMELS_site'].map(location['lat'])
+            result['lon'] = result['CAMELS_site'].map(location['lon'])
+
+        self.write_result(result, out)
+        os.remove(checkpoint)
+        return result
+
+    def _read_checkpoint(self, checkpoint):
+        """Sites whose rows for every requested metric are in the checkpoint
+
+        The checkpoint is rewritten with the rows of those sites only, dropping a chunk torn by a killed job.
+        Raises ValueError if it was written with other settings.
+        """
+        if not os.path.exists(checkpoint):
+            return set()
+        with open(checkpoint) as f:
+            text = f.read()
+        lines = text[:text.rfind('\n') + 1].splitlines()
+        if len(lines) < 2:
+            os.remove(checkpoint)
+            return set()
+        if lines[0] != self.settings:
+            raise ValueError(f'{checkpoint} was written with settings {lines[0]!r}, not {self.settings!r}; '
+                             f'rerun with those settings or remove it')
+        header = lines[1].split('\t')
+        site, stat = header.index('CAMELS_site'), header.index('GOF_stat')
+        fields = [line.split('\t') for line in lines[2:]]
+        complete = [row for row in fields if len(row) == len(header) and row[stat] in self.metrics]
+        stats = {}
+        for row in complete:
+            stats.setdefault(row[site], set()).add(row[stat])
+        done = {key for key, value in stats.items() if len(value) == len(self.metrics)}
+
+        temp_path = f'{checkpoint}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.settings + '\n')
+            f.writelines('\t'.join(row) + '\n' for row in [header] + [row for row in complete if row[site] in done])
+        os.replace(temp_path, checkpoint)
+        return {int(site) for site in done}
+
+    def _append_checkpoint(self, checkpoint, rows):
+        """Append the rows of a finished chunk in one write, after the settings and header of a new checkpoint"""
+        new = not os.path.exists(checkpoint) or os.path.getsize(checkpoint) == 0
+        with open(checkpoint, 'a') as f:
+            f.write((self.settings + '\n' if new else '') + rows.to_csv(sep='\t', index=False, header=new))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def write_result(result, out):
+        """Write the table as a `result_store` (.store), Parquet (.parquet) or in the tab-separated case 4 layout"""
+        if out.endswith('.store'):
+            return result_store.write(result, out)
+        print(f'\033[1;31mSaving {out}...\033[0m')
+        if out.endswith('.parquet'):
+            result.to_parquet(out, index=False)
+        else:
+            result.to_csv(out, sep='\t', index=False)
+        print('\033[1;31mDone.\033[0m')
+
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cli.py', description='Model Fidelity Metric tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    evaluate = commands.add_parser('evaluate', help='score a directory of CAMELS model outputs')
+    evaluate.add_argument('directory', help='directory of <gauge>_05_model_output.txt files, or a store')
+    evaluate.add_argument('--metrics', default=','.join(GOF_STATS),
+                          help=f'comma-separated subset of {",".join(GOF_STATS)} (default: all)')
+    evaluate.add_argument('--workers', type=int, default=1, help='worker processes (default: 1)')
+    evaluate.add_argument('--chunk-size', type=int, default=16, help='sites per scheduled task (default: 16)')
+    evaluate.add_argument('--n-boot', type=int, default=0,
+                          help='bootstrap replicates for the uncertainty columns (default: 0, score only)')
+    evaluate.add_argument('--seed', type=int, default=0, help='bootstrap seed (default: 0)')
+    evaluate.add_argument('--coords', help='table with CAMELS_site, lat and lon columns, e.g. data/case_4_mfm.txt')
+    evaluate.add_argument('--out', default='results.txt',
+                          help='output path: .store (columnar), .parquet or tab-separated text')
+
+    bench = commands.add_parser('benchmark', help='time every MFM component across series lengths')
+    bench.add_argument('--sizes', default=','.join(str(n) for n in [10 ** k for k in range(2, 8)]),
+                       help='comma-separated series lengths (default: 100 to 10000000)')
+    bench.add_argument('--min-time', type=float, default=0.2, help='seconds of repeats per case (default: 0.2)')
+    bench.add_argument('--out', default='benchmark.json', help='JSON output path')
+    bench.add_argument('--compare', help='previous JSON result to flag regressions against')
+    bench.add_argument('--threshold', type=float, default=1.2,
+                       help='slowdown ratio reported as a regression (default: 1.2)')
+
+    parity = commands.add_parser('parity', help='compare the Numba kernels with the NumPy reference (needs Numba)')
+    parity.add_argument('--tolerance', type=float, default=1e-9,
+                        help='largest difference accepted in float64 (default: 1e-9)')
+    parity.add_argument('--float32-tolerance', type=float, default=1e-5,
+                        help='largest difference accepted in float32 (default: 1e-5)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'evaluate':
+        engine = evaluator(metrics=[metric.strip() for metric in args.metrics.split(',')], n_boot=args.n_boot,
+                           seed=args.seed, chunk_size=args.chunk_size)
+        engine.run(args.directory, args.out, workers=args.workers, coords=args.coords)
+    elif args.command == 'benchmark':
+        from benchmark import benchmark
+        engine = benchmark(sizes=[int(n) for n in args.sizes.split(',')], min_time=args.min_time)
+        result = engine.run()
+        engine.write_result(result, args.out)
+        if args.compare:
+            regressions = engine.compare(args.compare, result, threshold=args.threshold)
+            for case, old, new, ratio in regressions:
+                print(f'\033[1;31mRegression {case}: {old * 1e3:.3f} ms -> {new * 1e3:.3f} ms ({ratio:.2f}x)\033[0m')
+            return 1 if regressions else 0
+    elif args.command == 'parity':
+        from mfm_numba import check_parity
+        table, passed = check_parity(tolerance=args.tolerance, float32_tolerance=args.float32_tolerance)
+        print(table.to_string(index=False))
+        if not passed:
+            print('\033[1;31mParity check failed.\033[0m')
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
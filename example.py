@@ -9,27 +9,41 @@ from case2 import *
 from case3 import *
 from case4 import *
 from case5 import *
+from case_data import case_data
+from figures import figures
 
 write_option = False
 # write_option = True
 
-case1 = case_1_error_compensation(write = write_option)
-case1.plot_sensitivity()
-case1.plot_error_compensation()
+# Headless mode: render every figure into temp/ in a process pool, without showing them
+render_option = False
+# render_option = True
 
-case2 = case_2_low_variability(write = write_option)
-case2.low_variability()
-case2.sensitivity()
+if render_option:
+    if __name__ == '__main__':
+        figures().render_all()
+else:
+    # Every dataset is computed once and shared by the figures; pass a directory to keep them between runs
+    data = case_data()
+    # data = case_data(directory='temp/case_data')
 
-case3 = case_3_phase_error(write = write_option)
-case3.geometry()
-case3.decoupling()
-case3.sensitivity()
+    case1 = case_1_error_compensation(write = write_option, data = data)
+    case1.plot_sensitivity()
+    case1.plot_error_compensation()
 
-case4 = case_4_real_world_data(write = write_option)
-case4.two_examples()
-case4.radar()
-case4.spatial_distribution()
+    case2 = case_2_low_variability(write = write_option, data = data)
+    case2.low_variability()
+    case2.sensitivity()
 
-case5 = case_5_sensitivity(write = write_option)
-case5.sensitivity()
\ No newline at end of file
+    case3 = case_3_phase_error(write = write_option, data = data)
+    case3.geometry()
+    case3.decoupling()
+    case3.sensitivity()
+
+    case4 = case_4_real_world_data(write = write_option, data = data)
+    case4.two_examples()
+    case4.radar()
+    case4.spatial_distribution()
+
+    case5 = case_5_sensitivity(write = write_option)
+    case5.sensitivity()
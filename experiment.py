@@ -0,0 +1,210 @@
+"""
+This script runs synthetic perturbation experiments: metric curves over families of perturbed simulations.
+
+A perturbation is declared once with its levels, e.g. `bias(levels=1 + np.arange(10 ** 4) / 100)`, and
+`experiment.run` builds its family of perturbed copies of each site as 2-D (levels, time) blocks and scores them
+through the batched MFM and baseline kernels (the Numba ones when available). When obs is not perturbed, the
+obs-only work is done once per site by an `observation` context. Blocks of `chunk_size` levels are built and
+scored one at a time, so memory does not grow with the number of levels, and sites can be spread over a
+process pool.
+
+    engine = experiment()
+    result = engine.run(sim, obs, sim_perturbation=[bias(k, stop=n), bias(2 - k, start=n)])
+    result.loc[(0, 1.5), 'MFM']
+
+Perturbations: multiplicative `bias`, `outlier` injection, circular `phase_shift` and Gaussian `noise`. A list
+of perturbations with the same number of levels is applied in order, level by level.
+"""
+
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from mfm import mfm
+from mfm_core import MFM_COMPONENTS, BASELINE_COMPONENTS, _float_array, _mfm_batch
+from observation import observation
+
+# A declared perturbation: its kind, one level per member of the family, and the options of its kind
+Perturbation = namedtuple('Perturbation', ['kind', 'levels', 'options'])
+
+OUTLIER_MODES = ['set', 'add', 'scale']
+
+
+def bias(levels, start=0, stop=None, center=0.0):
+    """Multiplicative bias: values -> center + level * (values - center), on the time steps start:stop"""
+    return Perturbation('bias', np.atleast_1d(np.asarray(levels, dtype=float)),
+                        {'start': start, 'stop': stop, 'center': center})
+
+
+def outlier(levels, index=-1, mode='set'):
+    """Outliers at the time steps `index`: set to the level, or `mode='add'` / `'scale'` it to the value"""
+    if mode not in OUTLIER_MODES:
+        raise ValueError(f'mode must be one of {OUTLIER_MODES}, got {mode!r}')
+    return Perturbation('outlier', np.atleast_1d(np.asarray(levels, dtype=float)), {'index': index, 'mode': mode})
+
+
+def phase_shift(levels):
+    """Circular shift by `level` time steps (later for positive levels); fractional shifts interpolate linearly"""
+    return Perturbation('phase_shift', np.atleast_1d(np.asarray(levels, dtype=float)), {})
+
+
+def noise(levels, seed=0, relative=True):
+    """Additive Gaussian noise: values + level * sigma * z
+
+    z is one standard normal realization per site, drawn from (seed, site) and shared by every level, so the
+    metric curves are smooth in the level. sigma is the standard deviation of each series with `relative=True`,
+    and 1 otherwise.
+    """
+    return Perturbation('noise', np.atleast_1d(np.asarray(levels, dtype=float)), {'seed': seed, 'relative': relative})
+
+
+def _apply_bias(values, levels, site, start, stop, center):
+    segment = values[:, start:stop]
+    segment -= center
+    segment *= levels[:, None]
+    segment += center
+
+
+def _apply_outlier(values, levels, site, index, mode):
+    if mode == 'set':
+        values[:, index] = levels[:, None] if np.ndim(index) else levels
+    elif mode == 'add':
+        values[:, index] += levels[:, None] if np.ndim(index) else levels
+    else:
+        values[:, index] *= levels[:, None] if np.ndim(index) else levels
+
+
+def _apply_phase_shift(values, levels, site):
+    n = values.shape[1]
+    whole = np.floor(levels)
+    fraction = (levels - whole)[:, None]
+    source = (np.arange(n)[None, :] - whole.astype(np.intp)[:, None]) % n
+    earlier = np.take_along_axis(values, source, axis=1)
+    later = np.take_along_axis(values, (source - 1) % n, axis=1)
+    values[:] = (1 - fraction) * earlier + fraction * later
+
+
+def _apply_noise(values, levels, site, seed, relative):
+    z = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(site,))).standard_normal(values.shape[1])
+    sigma = np.nanstd(values, axis=1) if relative else np.ones(len(values))
+    values += (levels * sigma)[:, None] * z.astype(values.dtype)
+
+
+_APPLY = {'bias': _apply_bias, 'outlier': _apply_outlier, 'phase_shift': _apply_phase_shift, 'noise': _apply_noise}
+
+
+def _as_list(perturbation):
+    if perturbation is None:
+        return []
+    return [perturbation] if isinstance(perturbation, Perturbation) else list(perturbation)
+
+
+def family(base, perturbation, start=0, stop=None, site=0):
+    """(stop - start, n_time) block of members start:stop of the family of perturbed copies of the series `base`
+
+    Without a perturbation, the members are unperturbed copies.
+    """
+    perturbations = _as_list(perturbation)
+    if stop is None:
+        stop = len(perturbations[0].levels)
+    values = np.repeat(_float_array(base)[None, :], stop - start, axis=0)
+    for item in perturbations:
+        _APPLY[item.kind](values, item.levels[start:stop], site, **item.options)
+    return values
+
+
+def _site_task(args):
+    """Process-pool entry point: metric rows of every level of one site"""
+    engine, site, sim, obs, sim_perturbation, obs_perturbation = args
+    return engine.site_array(sim, obs, sim_perturbation, obs_perturbation, site)
+
+
+class experiment:
+    def __init__(self, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, baseline=True, backend='numpy',
+                 chunk_size=256):
+        """`baseline=False` computes the MFM components only; `backend` is as in `mfm`"""
+        self.mfm_kwargs = {'p': p, 'bins_suse': bins_suse, 'bins_phi': bins_phi, 'c': c, 'phase': phase}
+        self.baseline = baseline
+        self.mfm_temp = mfm(backend=backend)
+        self.chunk_size = chunk_size
+
+        np.seterr(all='ignore')
+
+    @property
+    def components(self):
+        """Names of the metrics, in the column order of `site_array`"""
+        return MFM_COMPONENTS + (BASELINE_COMPONENTS if self.baseline else [])
+
+    def site_array(self, sim, obs, sim_perturbation=None, obs_perturbation=None, site=0):
+        """(n_levels, len(components)) metrics of the families of one site's sim and obs series"""
+        perturbations = _as_list(sim_perturbation) + _as_list(obs_perturbation)
+        n_levels = len(perturbations[0].levels)
+        mfm_kernel, baseline_kernel = self.mfm_temp.batch_kernels()
+
+        # The obs-only work of the NumPy kernel is shared by every level when obs is not perturbed
+        context = None
+        if obs_perturbation is None and mfm_kernel is _mfm_batch:
+            context = observation(obs, chunk_size=self.chunk_size, **self.mfm_kwargs)
+
+        result = np.empty((n_levels, len(self.components)))
+        for start in range(0, n_levels, self.chunk_size):
+            stop = min(start + self.chunk_size, n_levels)
+            sim_block = family(sim, sim_perturbation, start, stop, site)
+            obs_block = family(obs, obs_perturbation, start, stop, site)
+            if context is not None:
+                result[start:stop, :len(MFM_COMPONENTS)] = context.score_array(sim_block)
+            else:
+                result[start:stop, :len(MFM_COMPONENTS)] = mfm_kernel(sim_block, obs_block, **self.mfm_kwargs)
+            if self.baseline:
+                result[start:stop, len(MFM_COMPONENTS):] = baseline_kernel(sim_block, obs_block)
+        return result
+
+    def run_array(self, sim, obs, sim_perturbation=None, obs_perturbation=None, workers=1, progress=False):
+        """(n_sites, n_levels, len(components)) metrics of the perturbed families of every site
+
+        sim and obs are (n_time,) series or (n_sites, n_time) arrays; a single series is shared by every site.
+        The same perturbations are applied to every site. Sites are spread over `workers` processes.
+        """
+        perturbations = _as_list(sim_perturbation) + _as_list(obs_perturbation)
+        if not perturbations:
+            raise ValueError('Give at least one of sim_perturbation and obs_perturbation')
+        unknown = [item.kind for item in perturbations if item.kind not in _APPLY]
+        if unknown:
+            raise ValueError(f'Unknown perturbations {unknown}, expected a subset of {list(_APPLY)}')
+        if len({len(item.levels) for item in perturbations}) != 1:
+            raise ValueError(f'Perturbations must have the same number of levels, got '
+                             f'{[len(item.levels) for item in perturbations]}')
+
+        sim = np.atleast_2d(_float_array(sim))
+        obs = np.atleast_2d(_float_array(obs))
+        if sim.ndim != 2 or sim.shape[1] != obs.shape[1] or len(sim) != len(obs) and min(len(sim), len(obs)) != 1:
+            raise ValueError(f'sim and obs must be series or 2-D arrays of matching shape, got {sim.shape} and '
+                             f'{obs.shape}')
+        n_sites = max(len(sim), len(obs))
+        tasks = ((self, site, sim[site % len(sim)], obs[site % len(obs)], sim_perturbation, obs_perturbation)
+                 for site in range(n_sites))
+
+        result = np.empty((n_sites, len(perturbations[0].levels), len(self.components)))
+        with tqdm(total=n_sites, unit='site', disable=not progress) as bar:
+            if workers > 1 and n_sites > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    for site, values in enumerate(pool.map(_site_task, tasks,
+                                                           chunksize=max(1, n_sites // (4 * workers)))):
+                        result[site] = values
+                        bar.update()
+            else:
+                for site, task in enumerate(tasks):
+                    result[site] = _site_task(task)
+                    bar.update()
+        return result
+
+    def run(self, sim, obs, sim_perturbation=None, obs_perturbation=None, workers=1, progress=False):
+        """Metrics of the perturbed families of every site, as a DataFrame
+
+        One row per (site, level), with the levels of the first perturbation, and the columns of `components`.
+        """
+        values = self.run_array(sim, obs, sim_perturbation, obs_perturbation, workers, progress)
+        levels = (_as_list(sim_perturbation) + _as_list(obs_perturbation))[0].levels
+        index = pd.MultiIndex.from_product([range(values.shape[0]), levels], names=['site', 'level'])
+        return pd.DataFrame(values.reshape(-1, values.shape[2]), index=index, columns=self.components)
@@ -0,0 +1,125 @@
+"""
+This script renders every case-study figure headlessly, in parallel.
+
+Each figure is one job of a process pool running the non-interactive Agg backend: it is drawn once and saved in
+every output format, and the figures render concurrently. The case datasets are shared through an on-disk
+`case_data` directory. The datasets that several of the requested figures read (`SHARED_DATASETS`) are computed
+by the parent before the jobs start, so concurrent jobs never compute the same one.
+
+    figures(workers=8).render_all()                           # the full temp/ figure set
+    figures().render_all(['case_1_sensitivity'], formats=['png'])
+"""
+
+import importlib
+import inspect
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from case_data import case_data
+
+# Formats written by `save_figure`
+FIGURE_FORMATS = ['png', 'pdf']
+
+# Figure name: (module, case class, plotting method)
+FIGURES = {
+    'case_1_sensitivity': ('case1', 'case_1_error_compensation', 'plot_sensitivity'),
+    'case_1_error_compensation': ('case1', 'case_1_error_compensation', 'plot_error_compensation'),
+    'case_2_outlier': ('case2', 'case_2_low_variability', 'low_variability'),
+    'case_2_sensitivity': ('case2', 'case_2_low_variability', 'sensitivity'),
+    'case_3_geometry': ('case3', 'case_3_phase_error', 'geometry'),
+    'case_3_decoupling': ('case3', 'case_3_phase_error', 'decoupling'),
+    'case_3_sensitivity': ('case3', 'case_3_phase_error', 'sensitivity'),
+    'case_4_flow': ('case4', 'case_4_real_world_data', 'two_examples'),
+    'case_4_radar': ('case4', 'case_4_real_world_data', 'radar'),
+    'case_4_spatial_distribution': ('case4', 'case_4_real_world_data', 'spatial_distribution'),
+    'case_5_sensitivity': ('case5', 'case_5_sensitivity', 'sensitivity'),
+}
+
+# Datasets read by more than one figure: the (module, case class, method) computing it and the figures reading it
+SHARED_DATASETS = [
+    (('case1', 'case_1_error_compensation', 'error_compensation_data'),
+     {'case_1_sensitivity', 'case_1_error_compensation'}),
+]
+
+
+def save_figure(name, formats=FIGURE_FORMATS, fig=None, directory='temp'):
+    """Save the current figure (or `fig`) as <directory>/<name>.<format> for every format, at 300 dpi"""
+    import matplotlib.pyplot as plt
+    fig = plt.gcf() if fig is None else fig
+    print(f'\033[1;31mSaving {name}...\033[0m')
+    for file_format in formats:
+        fig.savefig(os.path.join(directory, f'{name}.{file_format}'), dpi=300, bbox_inches='tight')
+    print('\033[1;31mDone.\033[0m')
+
+    return 0
+
+
+def _headless():
+    """Switch the process to the Agg backend, where plt.show() does nothing"""
+    import matplotlib
+    matplotlib.use('Agg')
+    warnings.filterwarnings('ignore', message='.*non-interactive.*')
+
+
+def _case(module, case_class, data_directory, **kwargs):
+    """An instance of `case_class` from `module`, reading its datasets from `data_directory` when it takes any"""
+    case_class = getattr(importlib.import_module(module), case_class)
+    if 'data' in inspect.signature(case_class).parameters:
+        kwargs['data'] = case_data(data_directory)
+    return case_class(**kwargs)
+
+
+def _figure_task(args):
+    """Process-pool entry point: draw one figure and write it in every given format, returning the seconds taken"""
+    name, formats, data_directory = args
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    module, case_class, method = FIGURES[name]
+    with plt.rc_context():
+        getattr(_case(module, case_class, data_directory, write=True, formats=formats), method)()
+    plt.close('all')
+    return time.perf_counter() - start
+
+
+class figures:
+    def __init__(self, workers=None, data_directory='temp/case_data'):
+        """`workers` defaults to every core; `data_directory` persists the case datasets shared by the jobs"""
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.data_directory = data_directory
+
+    def render_all(self, names=None, formats=FIGURE_FORMATS, progress=True):
+        """Render the figures `names` (default: all of FIGURES) into temp/, returning the seconds of each figure"""
+        names = list(FIGURES) if names is None else list(names)
+        unknown = [name for name in names if name not in FIGURES]
+        if unknown:
+            raise ValueError(f'Unknown figures {unknown}, expected a subset of {list(FIGURES)}')
+
+        if self.workers > 1:
+            self.prepare_shared(names)
+
+        # Slow figures first, so they do not end up alone at the tail of the pool
+        tasks = [(name, list(formats), self.data_directory) for name in sorted(
+            names, key=lambda name: name != 'case_4_spatial_distribution')]
+        seconds = {}
+        with tqdm(total=len(tasks), unit='figure', disable=not progress) as bar:
+            if self.workers > 1:
+                with ProcessPoolExecutor(max_workers=self.workers, initializer=_headless) as pool:
+                    futures = {pool.submit(_figure_task, task): task[0] for task in tasks}
+                    for future in as_completed(futures):
+                        seconds[futures[future]] = future.result()
+                        bar.update()
+            else:
+                _headless()
+                for task in tasks:
+                    seconds[task[0]] = _figure_task(task)
+                    bar.update()
+        return seconds
+
+    def prepare_shared(self, names):
+        """Compute into `data_directory` the SHARED_DATASETS read by more than one of the figures `names`"""
+        for (module, case_class, method), readers in SHARED_DATASETS:
+            if len(readers.intersection(names)) > 1:
+                getattr(_case(module, case_class, self.data_directory), method)()
+        return 0
@@ -0,0 +1,427 @@
+"""
+This script is the NumPy-only core of the metrics: the vectorized kernels behind MFM and the baseline metrics.
+
+It is imported by `mfm` and by the batch modules (sweep, uncertainty, streaming, rolling), and imports nothing
+but NumPy, so worker processes and short-lived scripts start quickly. pandas is imported only when a
+pd.Series result is requested.
+"""
+
+import numpy as np
+from collections import namedtuple
+
+
+# Version of the metric definitions; bump it whenever a change alters any numeric result, to invalidate caches
+METRIC_VERSION = '1.0.1'
+
+# Kernel backends of `mfm`: the NumPy kernels below (the default), the compiled ones of `mfm_numba`, or the latter
+# when installed
+BACKENDS = ['auto', 'numpy', 'numba']
+
+# Labels of the MFM result, in the order used by the batched arrays
+MFM_COMPONENTS = ['MFM', 'PPF', 'exp(- NMAEp)', 'omega', 'varphi', 'eta']
+
+# Labels of the baseline metrics, in the order used by the batched arrays
+BASELINE_COMPONENTS = ['NSE', 'KGE', 'mKGE', 'RMSE', 'NRMSE', 'MAE', 'NMAE', 'alpha', 'beta', 'rprod', 'meanObs']
+
+# Lightweight results (return_type='tuple') and structured array rows (out=...), in the same field order.
+# 'exp(- NMAEp)' is not an identifier, so its field is named exp_NMAEp.
+MFMResult = namedtuple('MFMResult', ['MFM', 'PPF', 'exp_NMAEp', 'omega', 'varphi', 'eta'])
+BaselineResult = namedtuple('BaselineResult', BASELINE_COMPONENTS)
+MFM_DTYPE = np.dtype([(name, float) for name in MFMResult._fields])
+BASELINE_DTYPE = np.dtype([(name, float) for name in BaselineResult._fields])
+
+
+def _float_array(values):
+    """`values` as a float ndarray, without a copy when it already is one: float32 is kept, anything else is float64"""
+    values = np.asarray(values)
+    return values if values.dtype in (np.float32, np.float64) else values.astype(float)
+
+
+def _row_searchsorted(sorted_rows, n_valid, values):
+    """Left insertion points of `values` (n_rows, q) into the first `n_valid` entries of each sorted row
+
+    A branch-free bisection over the flattened rows: each power-of-two step advances every position whose
+    entry just before the candidate is still below the value, with one gather, compare and select per step.
+    """
+    width = sorted_rows.shape[1]
+    flat = sorted_rows.ravel()
+    base = (np.arange(len(sorted_rows)) * width)[:, None]
+    limit = n_valid[:, None]
+    position = np.zeros(values.shape, dtype=np.intp)
+    step = 1 << (max(width, 1).bit_length() - 1)
+    while step:
+        candidate = position + step
+        below = flat[base + np.minimum(candidate, width) - 1] < values
+        position = np.where(below & (candidate <= limit), candidate, position)
+        step >>= 1
+    return position
+
+
+def _sorted_histogram(sorted_values, lo, hi, bins):
+    """np.histogram counts on np.linspace(lo, hi, bins + 1) edges, from a sorted series within [lo, hi]"""
+    # Edges in the dtype of the values, so float32 series are searched without an upcast copy
+    interior = np.linspace(lo, hi, bins + 1)[1:-1].astype(sorted_values.dtype, copy=False)
+    cumulative = np.searchsorted(sorted_values, interior, side='left')
+    return np.diff(np.concatenate(([0], cumulative, [len(sorted_values)])))
+
+
+def _sorted_histograms(sorted_rows, n_valid, lo, hi, bins):
+    """Row-wise np.histogram counts on np.linspace(lo, hi, bins + 1) edges, from sorted rows
+
+    Every value of a row lies in [lo, hi], so only the interior edges need to be located;
+    this is the same sort-and-search counting np.histogram uses for explicit edges.
+    """
+    interior = np.linspace(lo, hi, bins + 1, axis=-1)[:, 1:-1].astype(sorted_rows.dtype, copy=False)
+    if len(sorted_rows) <= 4:
+        # For a few rows, one np.searchsorted per row is cheaper than the vectorized bisection
+        searched = np.array([np.searchsorted(row[:n], edges, side='left')
+                             for row, n, edges in zip(sorted_rows, n_valid, interior)], dtype=np.intp)
+    else:
+        searched = _row_searchsorted(sorted_rows, n_valid, interior)
+    cumulative = np.column_stack([np.zeros(len(n_valid), dtype=np.intp), searched.reshape(interior.shape), n_valid])
+    return np.diff(cumulative, axis=1)
+
+
+def _twiddle(m, n):
+    """cos and sin of 2 * pi * m / n for integer m, exact at the quarter turns"""
+    quadrant, remainder = np.divmod(4 * m, n)
+    angle = 0.5 * np.pi * remainder / n
+    cos_r, sin_r = np.cos(angle), np.sin(angle)
+    quadrant %= 4
+    cos_t = np.choose(quadrant, [cos_r, -sin_r, -cos_r, sin_r])
+    sin_t = np.choose(quadrant, [sin_r, cos_r, -sin_r, -cos_r])
+    return cos_t, sin_t
+
+
+def _dft_angle(real, imag, abs_sum):
+    """Angle of a directly summed DFT coefficient, taken as zero when within rounding error of zero"""
+    # The tolerance follows the precision of the summed values (abs_sum has their dtype)
+    rounding = 8 * np.finfo(np.asarray(abs_sum).dtype).eps * abs_sum
+    return np.where(np.hypot(real, imag) <= rounding, 0.0, np.arctan2(imag, real))
+
+
+def _row_entropy(counts):
+    """Shannon entropy of each row of histogram counts"""
+    total = counts.sum(axis=1, keepdims=True)
+    prob = counts / np.where(total > 0, total, 1)
+    positive = prob > 0
+    return -np.sum(np.where(positive, prob * np.log(np.where(positive, prob, 1.0)), 0.0), axis=1)
+
+
+def _single_bin_dft(rows, k, n, block_size=2 ** 16):
+    """DFT coefficient of each row at its own frequency index `k`, as an O(n) projection per row
+
+    Rows sharing an index are projected together onto exact twiddles, so only the one coefficient PPF needs
+    is evaluated instead of a full spectrum. The twiddles are built `block_size` samples at a time in the dtype
+    of the rows (so long series need no full-length temporaries), and the partial sums are accumulated in
+    float64. Returns the real parts, imaginary parts and the row abs sums.
+    """
+    real = np.zeros(len(rows))
+    imag = np.zeros(len(rows))
+    for k_value in np.unique(k):
+        k_rows = np.flatnonzero(k == k_value)
+        block = rows if len(k_rows) == len(rows) else rows[k_rows]
+        for start in range(0, n, block_size):
+            t = np.arange(start, min(start + block_size, n))
+            cos_t, sin_t = (twiddle.astype(rows.dtype, copy=False) for twiddle in _twiddle((k_value * t) % n, n))
+            real[k_rows] += block[:, start:start + block_size] @ cos_t
+            imag[k_rows] -= block[:, start:start + block_size] @ sin_t
+    return real, imag, np.abs(rows).sum(axis=1)
+
+
+def _block_dominant_frequency(obs_rows):
+    """Dominant obs frequency index and the obs phase there, for each row of an (n_rows, n) block without NaN"""
+    n = obs_rows.shape[1]
+
+    # Only obs needs its full spectrum, to locate the dominant frequency
+    fft_obs = np.fft.rfft(obs_rows, axis=1)
+    dominant_freq_idx = np.argmax(np.abs(fft_obs[:, 1:n // 2 + 1]), axis=1)
+    if n > 365:
+        dominant_freq_idx = np.maximum(dominant_freq_idx, 33)
+    dominant_freq_idx += 1
+    coefficient = fft_obs[np.arange(len(obs_rows)), dominant_freq_idx]
+    return dominant_freq_idx, _dft_angle(coefficient.real, coefficient.imag, np.abs(obs_rows).sum(axis=1))
+
+
+def _block_phase_difference(sim_rows, obs_rows):
+    """Phase difference at the dominant obs frequency for each row of two (n_rows, n) blocks without NaN"""
+    dominant_freq_idx, phase_obs = _block_dominant_frequency(obs_rows)
+
+    # sim is only needed at that single frequency
+    phase_sim = _dft_angle(*_single_bin_dft(sim_rows, dominant_freq_idx, obs_rows.shape[1]))
+
+    return (phase_sim - phase_obs + np.pi) % (2 * np.pi) - np.pi
+
+
+def _compacted_blocks(mask, n_valid, *arrays):
+    """(rows, blocks) for each valid count of at least 3: the rows sharing it, and those rows of every array
+    compacted into a rectangular (len(rows), n) block of their unmasked values"""
+    for n in np.unique(n_valid):
+        if n < 3:
+            continue
+        rows = np.flatnonzero(n_valid == n)
+        if n == mask.shape[1]:
+            # Rows without masked values are used in place (every row, for gap-free input)
+            yield rows, [array if len(rows) == len(array) else array[rows] for array in arrays]
+        else:
+            row_mask = mask[rows]
+            yield rows, [array[rows][row_mask].reshape(len(rows), n) for array in arrays]
+
+
+def _row_phase_difference(sim, obs, mask, n_valid):
+    """Phase difference at the dominant obs frequency for each row of the masked series"""
+    phase_difference = np.zeros(len(n_valid))
+    for rows, (sim_rows, obs_rows) in _compacted_blocks(mask, n_valid, sim, obs):
+        phase_difference[rows] = _block_phase_difference(sim_rows, obs_rows)
+    return phase_difference
+
+
+def _row_dominant_frequency(obs, mask, n_valid):
+    """Dominant frequency index and obs phase of each row of the masked obs (0 for rows under 3 values)"""
+    dominant_freq_idx = np.zeros(len(n_valid), dtype=np.intp)
+    phase_obs = np.zeros(len(n_valid))
+    for rows, (obs_rows,) in _compacted_blocks(mask, n_valid, obs):
+        dominant_freq_idx[rows], phase_obs[rows] = _block_dominant_frequency(obs_rows)
+    return dominant_freq_idx, phase_obs
+
+
+def _prepare_batch(sim, obs, phase):
+    """Hyperparameter-free stage of the batched MFM
+
+    Masks each row and keeps the rows that can be scored. Everything that does not depend on p, bins_suse,
+    bins_phi or c is computed here: the absolute errors, the obs mean, the phase difference and the sorted
+    rows every histogram is read from. Returns None when no row can be scored.
+    """
+    mask = np.isfinite(sim) & np.isfinite(obs)
+    all_valid = bool(mask.all())
+    n_valid = mask.sum(axis=1)
+    mean_obs = (obs if all_valid else np.where(mask, obs, 0.0)).sum(axis=1, dtype=float) / np.maximum(n_valid, 1)
+    good = np.flatnonzero((n_valid >= 3) & (mean_obs != 0))
+    if len(good) == 0:
+        return None
+    if len(good) < sim.shape[0]:
+        sim, obs, mask = sim[good], obs[good], mask[good]
+        n_valid, mean_obs = n_valid[good], mean_obs[good]
+
+    # Each series is sorted once (masked values last)
+    sim_sorted = np.sort(sim if all_valid else np.where(mask, sim, np.nan), axis=1)
+    obs_sorted = np.sort(obs if all_valid else np.where(mask, obs, np.nan), axis=1)
+    take = np.arange(len(good))
+    sim_min, sim_max = sim_sorted[:, 0], sim_sorted[take, n_valid - 1]
+    obs_min, obs_max = obs_sorted[:, 0], obs_sorted[take, n_valid - 1]
+
+    return {
+        'good': good,
+        'n_valid': n_valid,
+        'mean_obs': mean_obs,
+        'error': np.abs(sim - obs) if all_valid else np.abs(np.where(mask, sim - obs, 0.0)),
+        'phase_difference': _row_phase_difference(sim, obs, mask, n_valid) if phase else None,
+        'sim_sorted': sim_sorted,
+        'obs_sorted': obs_sorted,
+        'sim_range': (sim_min, sim_max),
+        'obs_range': (obs_min, obs_max),
+        'lo': np.minimum(sim_min, obs_min),
+        'hi': np.maximum(sim_max, obs_max),
+        'scaled_histograms': {},
+        'unscaled_histograms': {},
+    }
+
+
+def _nmaep(sim, obs, mean_obs, p):
+    """Normalized p-norm error of one masked sim/obs pair, on one error buffer reused in place"""
+    error = np.subtract(sim, obs)
+    np.abs(error, out=error)
+    if p != 1:
+        np.power(error, p, out=error)
+    return np.power(np.mean(error, dtype=float), 1 / p) / abs(mean_obs)
+
+
+def _batch_nmaep(state, p):
+    """Normalized p-norm error of each prepared row"""
+    error = state['error'] if p == 1 else np.power(state['error'], p)
+    return np.power(error.sum(axis=1, dtype=float) / state['n_valid'], 1 / p) / np.abs(state['mean_obs'])
+
+
+def _batch_scaled_histograms(state, bins):
+    """sim and obs histograms on the shared value range, memoized per bin count"""
+    if bins not in state['scaled_histograms']:
+        state['scaled_histograms'][bins] = (
+            _sorted_histograms(state['sim_sorted'], state['n_valid'], state['lo'], state['hi'], bins),
+            _sorted_histograms(state['obs_sorted'], state['n_valid'], state['lo'], state['hi'], bins))
+    return state['scaled_histograms'][bins]
+
+
+def _batch_unscaled_histograms(state, bins):
+    """sim and obs histograms, each on its own value range, memoized per bin count"""
+    if bins not in state['unscaled_histograms']:
+        state['unscaled_histograms'][bins] = (
+            _sorted_histograms(state['sim_sorted'], state['n_valid'], *state['sim_range'], bins),
+            _sorted_histograms(state['obs_sorted'], state['n_valid'], *state['obs_range'], bins))
+    return state['unscaled_histograms'][bins]
+
+
+def _batch_suse(state, bins_suse):
+    """Scaled and Unscaled Shannon Entropy difference of each prepared row"""
+
+    def unscaled_entropy(counts, v_min, v_max):
+        return np.where(v_min == v_max, 0.0, _row_entropy(counts))
+
+    hist_sim_s, hist_obs_s = _batch_scaled_histograms(state, bins_suse)
+    hist_sim_u, hist_obs_u = _batch_unscaled_histograms(state, bins_suse)
+    Hs = np.abs(_row_entropy(hist_sim_s) - _row_entropy(hist_obs_s))
+    Hu = np.abs(unscaled_entropy(hist_sim_u, *state['sim_range']) - unscaled_entropy(hist_obs_u, *state['obs_range']))
+    return np.where(state['lo'] == state['hi'], 0.0, np.maximum(Hs, Hu))
+
+
+def _batch_phi(state, bins_phi):
+    """Percentage of Histogram Intersection of each prepared row"""
+    hist_sim_s, hist_obs_s = _batch_scaled_histograms(state, bins_phi)
+    phi = np.minimum(hist_sim_s, hist_obs_s).sum(axis=1) / state['n_valid']
+    return np.where(state['lo'] == state['hi'], 1.0, phi)
+
+
+def _batch_components(nmaep, phase_difference, suse, phi, c):
+    """Combine component arrays into the `MFM_COMPONENTS` columns, broadcasting over their shapes"""
+    if phase_difference is None:
+        phase_penalty_factor = np.nan
+        normalized_error = np.exp(-nmaep)
+    else:
+        phase_penalty_factor = np.cos(phase_difference / c)
+        normalized_error = phase_penalty_factor * np.exp(-nmaep)
+    variability_capture = np.exp(-suse)
+    distribution_similarity = phi
+
+    mfm_value = 1 - (np.sqrt(
+        ((1 - normalized_error) ** 2 +
+         (1 - variability_capture) ** 2 +
+         (1 - distribution_similarity) ** 2) / 3
+    ))
+
+    return np.broadcast_arrays(mfm_value, phase_penalty_factor, np.exp(-nmaep),
+                               normalized_error, variability_capture, distribution_similarity)
+
+
+def _mfm_batch(sim, obs, p, bins_suse, bins_phi, c, phase):
+    """Calculate MFM components for each row of 2-D sim and obs arrays"""
+    result = np.full((sim.shape[0], len(MFM_COMPONENTS)), np.nan)
+    state = _prepare_batch(sim, obs, phase)
+    if state is None:
+        return result
+
+    result[state['good']] = np.column_stack(_batch_components(
+        _batch_nmaep(state, p), state['phase_difference'], _batch_suse(state, bins_suse),
+        _batch_phi(state, bins_phi), c))
+    return result
+
+
+def _baseline_batch(sim, obs):
+    """Calculate the baseline metrics for each row of 2-D sim and obs arrays, over the jointly finite values
+
+    All moments come from one pass of fused row sums: sums, squares and the cross-product of the values
+    shifted by each row's first finite pair (so the variances do not cancel), plus the error sums.
+    Returns an (n_rows, len(BASELINE_COMPONENTS)) array; rows without finite pairs are NaN. float32 rows are
+    shifted and masked in float32 and summed in float64.
+    """
+    mask = np.isfinite(sim) & np.isfinite(obs)
+    all_valid = bool(mask.all())
+    n = mask.sum(axis=1)
+    rows = np.arange(len(n))
+    first = np.argmax(mask, axis=1)
+    sim_shift = sim[rows, first]
+    obs_shift = obs[rows, first]
+    sim_d = sim - sim_shift[:, None]
+    obs_d = obs - obs_shift[:, None]
+    error = sim - obs
+    if not all_valid:
+        # The differences are fresh temporaries, so they are masked in place
+        invalid = ~mask
+        for values in [sim_d, obs_d, error]:
+            np.copyto(values, 0.0, where=invalid)
+
+    sum_sim = sim_d.sum(axis=1, dtype=float)
+    sum_obs = obs_d.sum(axis=1, dtype=float)
+    sum_sim2 = np.einsum('ij,ij->i', sim_d, sim_d, dtype=float)
+    sum_obs2 = np.einsum('ij,ij->i', obs_d, obs_d, dtype=float)
+    sum_cross = np.einsum('ij,ij->i', sim_d, obs_d, dtype=float)
+    sum_error2 = np.einsum('ij,ij->i', error, error, dtype=float)
+    np.abs(error, out=error)
+    sum_abs_error = error.sum(axis=1, dtype=float)
+
+    meanSim_d = sum_sim / n
+    meanObs_d = sum_obs / n
+    meanSim = sim_shift + meanSim_d
+    meanObs = obs_shift + meanObs_d
+    varSim = np.maximum(sum_sim2 / n - meanSim_d ** 2, 0.0)
+    varObs = np.maximum(sum_obs2 / n - meanObs_d ** 2, 0.0)
+    rProd = (sum_cross / n - meanSim_d * meanObs_d) / np.sqrt(varSim * varObs)
+    xBeta = meanSim / meanObs
+    yBeta = (meanObs - meanSim) / np.sqrt(varObs)
+    alpha = np.sqrt(varSim) / np.sqrt(varObs)
+
+    nse = 2 * alpha * rProd - yBeta ** 2 - alpha ** 2
+    kge = 1 - np.sqrt((xBeta - 1) ** 2 + (alpha - 1) ** 2 + (rProd - 1) ** 2)
+    mkge = 1 - np.sqrt((xBeta - 1) ** 2 + (alpha / xBeta - 1) ** 2 + (rProd - 1) ** 2)
+    rmse = np.sqrt(sum_error2 / n)
+    nrmse = rmse / meanObs
+    mae = sum_abs_error / n
+    nmae = mae / meanObs
+
+    result = np.column_stack([nse, kge, mkge, rmse, nrmse, mae, nmae, alpha, xBeta, rProd, meanObs])
+    result[n == 0] = np.nan
+    return result
+
+
+def water_years(year, month):
+    """Water year (October to September) of each day"""
+    return np.asarray(year, dtype=int) + (np.asarray(month) >= 10)
+
+
+def _block_layout(blocks):
+    """Day order, start and length of each block, as contiguous runs of the block-sorted days"""
+    order = np.argsort(blocks, kind='stable')
+    _, start, length = np.unique(blocks[order], return_index=True, return_counts=True)
+    return order, start, length
+
+
+def _replicate_indices(choice, order, start, length):
+    """Padded day-index matrix of replicates made by concatenating the chosen blocks (-1 marks padding)"""
+    lengths = length[choice]
+    total = lengths.sum(axis=1)
+    flat_length = lengths.ravel()
+    n_days = int(total.sum())
+
+    # Position of each day within its replicate, and the day it is taken from
+    rows = np.repeat(np.arange(choice.shape[0]), total)
+    position = np.arange(n_days) - np.repeat(np.cumsum(total) - total, total)
+    within_block = np.arange(n_days) - np.repeat(np.cumsum(flat_length) - flat_length, flat_length)
+    day = np.repeat(start[choice].ravel(), flat_length) + within_block
+
+    index = np.full((choice.shape[0], total.max()), -1, dtype=np.intp)
+    index[rows, position] = order[day]
+    return index
+
+
+def _format_result(values, result_type, labels, return_type, out):
+    """Return metric values as a pd.Series (default), a named tuple, or written into a structured array
+
+    `values` is None when the series cannot be scored: the Series form keeps returning np.nan, the other
+    forms are filled with NaN. `out` is one row of a structured array of `result_type`'s fields, either
+    indexed (`results[j]`, a view of that row) or sliced (`results[j:j + 1]`).
+    """
+    if out is not None:
+        if not (isinstance(out, (np.void, np.ndarray)) and out.dtype.names == result_type._fields and out.size == 1):
+            raise ValueError(f'out must be one row of a structured array with the fields {result_type._fields}, '
+                             f'e.g. results[j] or results[j:j + 1]')
+        values = tuple(values) if values is not None else (np.nan,) * len(labels)
+        # Field by field, since an indexed row (np.void) cannot be assigned through out[...]
+        for name, value in zip(result_type._fields, values):
+            out[name] = value
+        return out
+    if return_type == 'tuple':
+        return result_type(*values) if values is not None else result_type(*([np.nan] * len(labels)))
+    if return_type != 'series':
+        raise ValueError(f"return_type must be 'series' or 'tuple', got {return_type!r}")
+    if values is None:
+        return np.nan
+    import pandas as pd
+    return pd.Series(dict(zip(labels, values)))
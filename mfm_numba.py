@@ -0,0 +1,346 @@
+"""
+This script is the optional Numba backend of the metrics: compiled row kernels behind MFM and the baseline metrics.
+
+Each site is one iteration of a parallel loop that masks, sums the error norm, projects sim onto the dominant
+obs frequency, sorts, bins and takes the entropies in a single compiled function, instead of a chain of small
+NumPy calls. Only the obs spectrum, which needs an FFT, is left to NumPy (`_row_dominant_frequency`).
+Results match the NumPy kernels of `mfm_core` to rounding; `check_parity` measures it.
+
+Numba is optional and opt-in: `mfm` runs on the NumPy kernels unless `backend='numba'` (or 'auto', which picks
+Numba when it is installed) is passed. `test_mfm_numba.py` runs the parity checks under Numba. Compiled code is
+cached on disk, so only the first call on a machine pays for compilation.
+"""
+
+import numpy as np
+from mfm_core import BACKENDS, MFM_COMPONENTS, BASELINE_COMPONENTS, _row_dominant_frequency
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+prange = numba.prange if NUMBA_AVAILABLE else range
+
+
+def _kernel(**options):
+    """numba.njit with NumPy division semantics (x / 0 gives inf or NaN); functions stay Python without Numba"""
+    if not NUMBA_AVAILABLE:
+        return lambda function: function
+    return numba.njit(cache=True, error_model='numpy', **options)
+
+
+def resolve_backend(backend='numpy'):
+    """'numba' or 'numpy' for a backend name; 'auto' is 'numba' when Numba is installed"""
+    if backend not in BACKENDS:
+        raise ValueError(f'backend must be one of {BACKENDS}, got {backend!r}')
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError("backend='numba' requires Numba (pip install numba)")
+    if backend == 'auto':
+        return 'numba' if NUMBA_AVAILABLE else 'numpy'
+    return backend
+
+
+@_kernel()
+def _histogram(sorted_values, lo, hi, bins):
+    """np.histogram counts on np.linspace(lo, hi, bins + 1) edges, from a sorted series within [lo, hi]
+
+    The edges are rounded to the dtype of the values after every step, as np.linspace computes them.
+    """
+    step = np.empty(1, dtype=sorted_values.dtype)
+    step[0] = hi - lo
+    step[0] = step[0] / bins
+    interior = np.empty(bins - 1, dtype=sorted_values.dtype)
+    for b in range(1, bins):
+        interior[b - 1] = b * step[0]
+        interior[b - 1] = interior[b - 1] + lo
+    cumulative = np.searchsorted(sorted_values, interior)
+    counts = np.empty(bins, dtype=np.int64)
+    previous = 0
+    for b in range(bins - 1):
+        counts[b] = cumulative[b] - previous
+        previous = cumulative[b]
+    counts[bins - 1] = len(sorted_values) - previous
+    return counts
+
+
+@_kernel()
+def _entropy(counts):
+    """Shannon entropy of histogram counts"""
+    total = counts.sum()
+    if total == 0:
+        return 0.0
+    result = 0.0
+    for count in counts:
+        if count > 0:
+            prob = count / total
+            result -= prob * np.log(prob)
+    return result
+
+
+@_kernel()
+def _dft_phase(values, k, eps):
+    """Angle of the DFT coefficient of `values` at index `k` on exact twiddles, zero within rounding of zero"""
+    n = len(values)
+    real = 0.0
+    imag = 0.0
+    abs_sum = 0.0
+    for t in range(n):
+        m = (k * t) % n
+        quadrant = (4 * m) // n % 4
+        angle = 0.5 * np.pi * ((4 * m) % n) / n
+        cos_r = np.cos(angle)
+        sin_r = np.sin(angle)
+        if quadrant == 0:
+            cos_t, sin_t = cos_r, sin_r
+        elif quadrant == 1:
+            cos_t, sin_t = -sin_r, cos_r
+        elif quadrant == 2:
+            cos_t, sin_t = -cos_r, -sin_r
+        else:
+            cos_t, sin_t = sin_r, -cos_r
+        real += values[t] * cos_t
+        imag -= values[t] * sin_t
+        abs_sum += abs(values[t])
+    if np.hypot(real, imag) <= 8 * eps * abs_sum:
+        return 0.0
+    return np.arctan2(imag, real)
+
+
+@_kernel()
+def _mfm_row(sim, obs, k, phase_obs, p, bins_suse, bins_phi, c, phase, eps, out):
+    """MFM components of one series into `out` (left NaN when it cannot be scored)"""
+    sim_clean = np.empty(len(sim), dtype=sim.dtype)
+    obs_clean = np.empty(len(obs), dtype=obs.dtype)
+    n = 0
+    for t in range(len(sim)):
+        if np.isfinite(sim[t]) and np.isfinite(obs[t]):
+            sim_clean[n] = sim[t]
+            obs_clean[n] = obs[t]
+            n += 1
+    if n < 3:
+        return
+    sim_clean = sim_clean[:n]
+    obs_clean = obs_clean[:n]
+
+    # 1. Normalized error with phase penalty (summed in float64 whatever the dtype)
+    sum_obs = 0.0
+    sum_error = 0.0
+    for t in range(n):
+        sum_obs += float(obs_clean[t])
+        error = abs(sim_clean[t] - obs_clean[t])
+        sum_error += float(error) if p == 1 else float(error ** p)
+    mean_obs = sum_obs / n
+    if mean_obs == 0:
+        return
+    nmaep = (sum_error / n) ** (1 / p) / abs(mean_obs)
+
+    if phase:
+        phase_difference = (_dft_phase(sim_clean, k, eps) - phase_obs + np.pi) % (2 * np.pi) - np.pi
+        phase_penalty_factor = np.cos(phase_difference / c)
+        normalized_error = phase_penalty_factor * np.exp(-nmaep)
+    else:
+        phase_penalty_factor = np.nan
+        normalized_error = np.exp(-nmaep)
+
+    # 2. Variability capture and 3. Distribution similarity from the sorted series
+    sim_sorted = np.sort(sim_clean)
+    obs_sorted = np.sort(obs_clean)
+    sim_min, sim_max = sim_sorted[0], sim_sorted[n - 1]
+    obs_min, obs_max = obs_sorted[0], obs_sorted[n - 1]
+    lo = min(sim_min, obs_min)
+    hi = max(sim_max, obs_max)
+    if lo == hi:
+        suse = 0.0
+        phi = 1.0
+    else:
+        hist_sim = _histogram(sim_sorted, lo, hi, bins_suse)
+        hist_obs = _histogram(obs_sorted, lo, hi, bins_suse)
+        Hs = abs(_entropy(hist_sim) - _entropy(hist_obs))
+        Hu_sim = 0.0 if sim_min == sim_max else _entropy(_histogram(sim_sorted, sim_min, sim_max, bins_suse))
+        Hu_obs = 0.0 if obs_min == obs_max else _entropy(_histogram(obs_sorted, obs_min, obs_max, bins_suse))
+        suse = max(Hs, abs(Hu_sim - Hu_obs))
+        if bins_phi != bins_suse:
+            hist_sim = _histogram(sim_sorted, lo, hi, bins_phi)
+            hist_obs = _histogram(obs_sorted, lo, hi, bins_phi)
+        phi = np.minimum(hist_sim, hist_obs).sum() / n
+    variability_capture = np.exp(-suse)
+
+    out[0] = 1 - np.sqrt(((1 - normalized_error) ** 2 + (1 - variability_capture) ** 2 + (1 - phi) ** 2) / 3)
+    out[1] = phase_penalty_factor
+    out[2] = np.exp(-nmaep)
+    out[3] = normalized_error
+    out[4] = variability_capture
+    out[5] = phi
+
+
+@_kernel(parallel=True)
+def _mfm_rows(sim, obs, k, phase_obs, p, bins_suse, bins_phi, c, phase, eps, result):
+    for row in prange(sim.shape[0]):
+        _mfm_row(sim[row], obs[row], k[row], phase_obs[row], p, bins_suse, bins_phi, c, phase, eps, result[row])
+
+
+@_kernel()
+def _baseline_row(sim, obs, out):
+    """Baseline metrics of one series into `out`, from sums shifted by its first finite pair
+
+    The shifted values and errors are rounded to the dtype of the series and summed in float64, as in
+    `mfm_core._baseline_batch`.
+    """
+    first = 0
+    while first < len(sim) and not (np.isfinite(sim[first]) and np.isfinite(obs[first])):
+        first += 1
+    if first == len(sim):
+        return
+    sim_shift = sim[first]
+    obs_shift = obs[first]
+
+    n = 0
+    sum_sim = sum_obs = sum_sim2 = sum_obs2 = sum_cross = sum_error2 = sum_abs_error = 0.0
+    for t in range(first, len(sim)):
+        if not (np.isfinite(sim[t]) and np.isfinite(obs[t])):
+            continue
+        n += 1
+        sim_d = float(sim[t] - sim_shift)
+        obs_d = float(obs[t] - obs_shift)
+        error = float(sim[t] - obs[t])
+        sum_sim += sim_d
+        sum_obs += obs_d
+        sum_sim2 += sim_d * sim_d
+        sum_obs2 += obs_d * obs_d
+        sum_cross += sim_d * obs_d
+        sum_error2 += error * error
+        sum_abs_error += abs(error)
+
+    meanSim_d = sum_sim / n
+    meanObs_d = sum_obs / n
+    meanSim = sim_shift + meanSim_d
+    meanObs = obs_shift + meanObs_d
+    varSim = max(sum_sim2 / n - meanSim_d ** 2, 0.0)
+    varObs = max(sum_obs2 / n - meanObs_d ** 2, 0.0)
+    rProd = (sum_cross / n - meanSim_d * meanObs_d) / np.sqrt(varSim * varObs)
+    xBeta = meanSim / meanObs
+    yBeta = (meanObs - meanSim) / np.sqrt(varObs)
+    alpha = np.sqrt(varSim) / np.sqrt(varObs)
+    rmse = np.sqrt(sum_error2 / n)
+    mae = sum_abs_error / n
+
+    out[0] = 2 * alpha * rProd - yBeta ** 2 - alpha ** 2
+    out[1] = 1 - np.sqrt((xBeta - 1) ** 2 + (alpha - 1) ** 2 + (rProd - 1) ** 2)
+    out[2] = 1 - np.sqrt((xBeta - 1) ** 2 + (alpha / xBeta - 1) ** 2 + (rProd - 1) ** 2)
+    out[3] = rmse
+    out[4] = rmse / meanObs
+    out[5] = mae
+    out[6] = mae / meanObs
+    out[7] = alpha
+    out[8] = xBeta
+    out[9] = rProd
+    out[10] = meanObs
+
+
+@_kernel(parallel=True)
+def _baseline_rows(sim, obs, result):
+    for row in prange(sim.shape[0]):
+        _baseline_row(sim[row], obs[row], result[row])
+
+
+def _mfm_batch_numba(sim, obs, p, bins_suse, bins_phi, c, phase):
+    """Drop-in for `mfm_core._mfm_batch` on the compiled kernels"""
+    sim, obs = np.ascontiguousarray(sim), np.ascontiguousarray(obs)
+    result = np.full((sim.shape[0], len(MFM_COMPONENTS)), np.nan)
+    if phase:
+        mask = np.isfinite(sim) & np.isfinite(obs)
+        k, phase_obs = _row_dominant_frequency(obs, mask, mask.sum(axis=1))
+    else:
+        k, phase_obs = np.zeros(sim.shape[0], dtype=np.intp), np.zeros(sim.shape[0])
+    eps = float(np.finfo(np.result_type(sim, obs)).eps)
+    _mfm_rows(sim, obs, k, phase_obs, float(p), int(bins_suse), int(bins_phi), float(c), bool(phase), eps, result)
+    return result
+
+
+def _baseline_batch_numba(sim, obs):
+    """Drop-in for `mfm_core._baseline_batch` on the compiled kernels"""
+    result = np.full((sim.shape[0], len(BASELINE_COMPONENTS)), np.nan)
+    _baseline_rows(np.ascontiguousarray(sim), np.ascontiguousarray(obs), result)
+    return result
+
+
+def check_parity(sim=None, obs=None, tolerance=1e-9, float32_tolerance=1e-5, seed=0):
+    """Largest difference of every component between the Numba kernels and the NumPy reference
+
+    `sim` and `obs` are (n_sites, n_time) arrays; by default the CAMELS sample sites and synthetic series
+    (with NaN values, constant, short and phase-shifted ones) are used, in float64 and float32. Both are
+    compared with `mfm.model_fidelity_metric` / `baseline_metrics` on the NumPy backend (absolute differences
+    for MFM, relative to max(|value|, 1) for the baseline metrics). Returns (table, passed), where `passed` is
+    whether every difference is within the tolerance of its dtype and the NaN patterns agree.
+    """
+    import pandas as pd
+    from mfm import mfm
+    resolve_backend('numba')
+    reference = mfm(backend='numpy')
+
+    if sim is None:
+        sim, obs = _parity_cases(seed)
+    sim, obs = np.asarray(sim, dtype=float), np.asarray(obs, dtype=float)
+
+    rows = []
+    for dtype, limit in [(np.float64, tolerance), (np.float32, float32_tolerance)]:
+        sim_rows, obs_rows = sim.astype(dtype), obs.astype(dtype)
+        checks = []
+        for kwargs in [{}, dict(p=2, bins_suse=15, bins_phi=20, c=3), dict(phase=False)]:
+            params = {'p': 1, 'bins_suse': 10, 'bins_phi': 10, 'c': 4, 'phase': True, **kwargs}
+            expected = np.array([reference.model_fidelity_metric(s, o, return_type='tuple', **params)
+                                 for s, o in zip(sim_rows, obs_rows)])
+            actual = _mfm_batch_numba(sim_rows, obs_rows, **params)
+            checks.append((repr(kwargs), MFM_COMPONENTS, expected, actual, False))
+        expected = np.array([reference.baseline_metrics(s, o, return_type='tuple') for s, o in zip(sim_rows, obs_rows)])
+        checks.append(('{}', BASELINE_COMPONENTS, expected, _baseline_batch_numba(sim_rows, obs_rows), True))
+
+        for params, components, expected, actual, relative in checks:
+            same_nan = np.isnan(expected) == np.isnan(actual)
+            difference = np.abs(expected - actual)
+            if relative:
+                difference /= np.maximum(np.abs(expected), 1.0)
+            for j, component in enumerate(components):
+                worst = np.nanmax(difference[:, j], initial=0.0)
+                rows.append({'dtype': np.dtype(dtype).name, 'params': params, 'component': component,
+                             'max_difference': worst, 'nan_match': bool(same_nan[:, j].all()),
+                             'passed': bool(same_nan[:, j].all() and worst <= limit)})
+
+    table = pd.DataFrame(rows)
+    return table, bool(table['passed'].all())
+
+
+def _parity_cases(seed):
+    """CAMELS sample sites plus synthetic edge cases, NaN-padded to a common length"""
+    import os
+    from read_file import read_file, MODEL_OUTPUT_PATTERN
+    rng = np.random.default_rng(seed)
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    series = []
+    for name in sorted(os.listdir(directory)):
+        if MODEL_OUTPUT_PATTERN.match(name):
+            flow = read_file(cache=False).read_flow(os.path.join(directory, name))
+            series.append((flow['sim'].to_numpy(), flow['obs'].to_numpy()))
+    obs = rng.gamma(0.8, 1.0, 3000) * (1.5 + np.sin(2 * np.pi * np.arange(3000) / 365.25))
+    gappy = obs.copy()
+    gappy[rng.random(3000) < 0.1] = np.nan
+    series += [
+        (np.roll(obs, 30), obs),
+        (obs * 1.2, gappy),
+        (np.full(3000, 2.0), obs),
+        (obs, np.full(3000, 2.0)),
+        (np.full(3000, 1.0), np.full(3000, 1.0)),
+        (obs[:200] + rng.normal(0, 0.1, 200), obs[:200]),
+        (obs[:5], obs[:5][::-1]),
+        (obs[:2], obs[:2]),
+        (obs - obs.mean(), obs - obs.mean()),
+    ]
+    length = max(len(s) for s, _ in series)
+    sim_rows = np.full((len(series), length), np.nan)
+    obs_rows = np.full((len(series), length), np.nan)
+    for row, (s, o) in enumerate(series):
+        sim_rows[row, :len(s)] = s
+        obs_rows[row, :len(o)] = o
+    return sim_rows, obs_rows
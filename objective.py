@@ -0,0 +1,153 @@
+"""
+This script is MFM as a calibration objective: a scalar per simulation, or one per member of a population.
+
+Optimizers call the objective 10^5 to 10^6 times against the same obs, so everything about obs and the
+hyperparameters is validated and precomputed once by an `observation` context. A call then writes the sim-only
+work into preallocated buffers (error norm, single-bin DFT, an in-place sort and a few bin searches) and
+combines the components as Python floats, without building closures, a pd.Series or the jointly masked obs.
+Simulations with NaN values on the obs mask fall back to the full calculation, so results match
+`mfm.model_fidelity_metric`.
+
+    loss = objective(obs, maximize=False)     # 1 - MFM, for minimizers
+    loss(sim)                                 # float
+    loss.population(simulations)              # (n_members,) array, for evolutionary optimizers
+"""
+
+import math
+import numpy as np
+from mfm_core import MFM_COMPONENTS
+from observation import observation
+
+
+def _counts(sorted_values, interior):
+    """Histogram counts of a sorted series within the outer edges, from its interior edges"""
+    cumulative = np.empty(len(interior) + 2, dtype=np.intp)
+    cumulative[0] = 0
+    cumulative[1:-1] = np.searchsorted(sorted_values, interior, side='left')
+    cumulative[-1] = len(sorted_values)
+    return cumulative[1:] - cumulative[:-1]
+
+
+def _entropy(counts, n):
+    """Shannon entropy of histogram counts summing to n"""
+    prob = counts[counts > 0] / n
+    return -float(np.dot(prob, np.log(prob)))
+
+
+class objective:
+    def __init__(self, obs, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, component='MFM', maximize=True,
+                 invalid=np.nan, check_finite=True):
+        """MFM `component` of a simulation against `obs`, or 1 - component with `maximize=False`
+
+        `invalid` is returned for simulations that cannot be scored (e.g. -np.inf for a maximizer). With
+        `check_finite=False`, simulations are trusted to be finite wherever obs is, which skips one check per call.
+        """
+        if component not in MFM_COMPONENTS:
+            raise ValueError(f'component must be one of {MFM_COMPONENTS}, got {component!r}')
+        if component == 'PPF' and not phase:
+            raise ValueError("component='PPF' requires phase=True")
+        if int(bins_suse) != bins_suse or int(bins_phi) != bins_phi or bins_suse < 1 or bins_phi < 1:
+            raise ValueError(f'bins_suse and bins_phi must be positive integers, got {bins_suse} and {bins_phi}')
+        if p <= 0 or c == 0:
+            raise ValueError(f'p must be positive and c non-zero, got p={p} and c={c}')
+        self.context = observation(obs, p=p, bins_suse=int(bins_suse), bins_phi=int(bins_phi), c=c, phase=phase)
+        if self.context.obs.ndim != 1:
+            raise ValueError(f'obs must be 1-D, got shape {self.context.obs.shape}')
+        if not self.context.scorable:
+            raise ValueError('obs cannot be scored: fewer than 3 finite values or a zero mean')
+
+        self.component = component
+        self.column = MFM_COMPONENTS.index(component)
+        self.maximize = maximize
+        self.invalid = invalid
+        self.check_finite = check_finite
+
+        # Buffers reused by every call
+        context = self.context
+        self._error = np.empty(context.n, dtype=context.obs.dtype)
+        self._sorted = np.empty(context.n, dtype=context.obs.dtype)
+        self._eps = float(np.finfo(context.obs.dtype).eps)
+        self._ramps = {bins: np.arange(1, bins, dtype=context.obs.dtype)
+                       for bins in {context.bins_suse, context.bins_phi}}
+        self._obs_edges = {bins: self._interior(context.obs_min, context.obs_max, bins) for bins in self._ramps}
+
+    def __call__(self, sim):
+        """Objective value of one simulation"""
+        context = self.context
+        sim = np.asarray(sim)
+        sim_clean = sim if context.all_finite else sim[context.mask]
+        if self.check_finite and not np.isfinite(sim_clean).all():
+            return self._value(context.score_array(sim[None, :])[0, self.column])
+        if sim_clean.dtype != context.obs.dtype:
+            sim_clean = sim_clean.astype(context.obs.dtype)
+        return self._value(self._components(sim_clean)[self.column])
+
+    def population(self, sims):
+        """Objective values of every row of an (n_members, n_time) array"""
+        values = self.context.score_array(sims)[:, self.column]
+        if not self.maximize:
+            values = 1 - values
+        return np.where(np.isnan(values), self.invalid, values)
+
+    def _value(self, value):
+        if value != value:
+            return self.invalid
+        return value if self.maximize else 1 - value
+
+    def _interior(self, lo, hi, bins):
+        """Interior edges of np.linspace(lo, hi, bins + 1), computed as np.linspace does without its overhead"""
+        return self._ramps[bins] * ((hi - lo) / bins) + lo
+
+    def _histograms(self, sim_sorted, lo, hi, bins):
+        """sim and obs counts on the shared range, reusing the obs counts and edges when it is the obs range"""
+        context = self.context
+        if lo == context.obs_min and hi == context.obs_max:
+            return _counts(sim_sorted, self._obs_edges[bins]), context.obs_histograms[bins]
+        interior = self._interior(lo, hi, bins)
+        return _counts(sim_sorted, interior), _counts(context.obs_sorted, interior)
+
+    def _components(self, sim):
+        """MFM_COMPONENTS of a simulation aligned with obs_clean and finite, as Python floats"""
+        context = self.context
+        n = context.n
+        p = context.p
+
+        # 1. Normalized error with phase penalty
+        error = np.subtract(sim, context.obs_clean, out=self._error)
+        np.abs(error, out=error)
+        if p != 1:
+            np.power(error, p, out=error)
+        nmaep = (float(error.sum(dtype=float)) / n) ** (1 / p) / abs(context.mean_obs)
+
+        if context.phase:
+            real, imag = sim @ context.twiddles
+            abs_sum = float(np.abs(sim, out=self._error).sum(dtype=float))
+            phase_sim = 0.0 if math.hypot(real, imag) <= 8 * self._eps * abs_sum else math.atan2(imag, real)
+            phase_difference = (phase_sim - context.phase_obs + math.pi) % (2 * math.pi) - math.pi
+            phase_penalty_factor = math.cos(phase_difference / context.c)
+            normalized_error = phase_penalty_factor * math.exp(-nmaep)
+        else:
+            phase_penalty_factor = np.nan
+            normalized_error = math.exp(-nmaep)
+
+        # 2. Variability capture and 3. Distribution similarity from the sorted simulation
+        sim_sorted = self._sorted
+        sim_sorted[:] = sim
+        sim_sorted.sort()
+        sim_min, sim_max = sim_sorted[0], sim_sorted[-1]
+        lo, hi = min(sim_min, context.obs_min), max(sim_max, context.obs_max)
+        if lo == hi:
+            suse, phi = 0.0, 1.0
+        else:
+            hist_sim, hist_obs = self._histograms(sim_sorted, lo, hi, context.bins_suse)
+            Hs = abs(_entropy(hist_sim, n) - _entropy(hist_obs, n))
+            Hu_sim = 0.0 if sim_min == sim_max else _entropy(
+                _counts(sim_sorted, self._interior(sim_min, sim_max, context.bins_suse)), n)
+            suse = max(Hs, abs(Hu_sim - context.obs_entropy))
+            if context.bins_phi != context.bins_suse:
+                hist_sim, hist_obs = self._histograms(sim_sorted, lo, hi, context.bins_phi)
+            phi = float(np.minimum(hist_sim, hist_obs).sum()) / n
+        variability_capture = math.exp(-suse)
+
+        mfm_value = 1 - math.sqrt(((1 - normalized_error) ** 2 + (1 - variability_capture) ** 2 + (1 - phi) ** 2) / 3)
+        return (mfm_value, phase_penalty_factor, math.exp(-nmaep), normalized_error, variability_capture, phi)
@@ -0,0 +1,137 @@
+"""
+This script scores many simulations against one observation record, computing the obs-only work once.
+
+Calibration and model intercomparison score thousands of candidate simulations against the same obs. An
+observation context masks obs once and keeps its mean, sorted values and range, its dominant frequency and
+phase (one FFT) with the twiddles of that frequency, and its unscaled histogram entropy. Each candidate then
+only pays for its own error norm, single-bin DFT, sort and histograms.
+
+A candidate that widens the shared value range has the sorted obs re-binned on the wider range (one search per
+edge). A candidate with NaN values where obs is finite changes the jointly masked obs, so it is scored from
+scratch. Either way the results match `mfm.model_fidelity_metric` to rounding.
+
+    context = observation(obs)
+    context.score(sim)                  # one candidate, as a pd.Series
+    context.score_many(candidates)      # (n_candidates, n_time), as a DataFrame
+"""
+
+import numpy as np
+from mfm_core import (MFM_COMPONENTS, MFMResult, _float_array, _twiddle, _dft_angle, _row_entropy, _sorted_histogram,
+                      _sorted_histograms, _block_dominant_frequency, _batch_components, _mfm_batch, _format_result)
+
+
+class observation:
+    def __init__(self, obs, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, chunk_size=256):
+        self.p = p
+        self.bins_suse = bins_suse
+        self.bins_phi = bins_phi
+        self.c = c
+        self.phase = phase
+        self.chunk_size = chunk_size
+
+        np.seterr(all='ignore')
+
+        self.obs = _float_array(obs)
+        self.mask = np.isfinite(self.obs)
+        self.all_finite = bool(self.mask.all())
+        self.obs_clean = self.obs if self.all_finite else self.obs[self.mask]
+        self.n = len(self.obs_clean)
+        self.mean_obs = np.mean(self.obs_clean, dtype=float) if self.n else np.nan
+        self.scorable = self.n >= 3 and self.mean_obs != 0
+        if not self.scorable:
+            return
+
+        self.obs_sorted = np.sort(self.obs_clean)
+        self.obs_min, self.obs_max = self.obs_sorted[0], self.obs_sorted[-1]
+
+        # Histograms on the obs range, shared by every candidate that stays within it
+        self.obs_histograms = {bins: _sorted_histogram(self.obs_sorted, self.obs_min, self.obs_max, bins)
+                               for bins in {bins_suse, bins_phi}}
+        self.obs_entropy = 0.0 if self.obs_min == self.obs_max else _row_entropy(
+            self.obs_histograms[bins_suse][None, :])[0]
+
+        if phase:
+            k, phase_obs = _block_dominant_frequency(self.obs_clean[None, :])
+            self.dominant_freq_idx, self.phase_obs = int(k[0]), float(phase_obs[0])
+            cos_t, sin_t = _twiddle((self.dominant_freq_idx * np.arange(self.n)) % self.n, self.n)
+            self.twiddles = np.stack([cos_t, -sin_t], axis=1).astype(self.obs.dtype)
+
+    def score(self, sim, return_type='series', out=None):
+        """MFM of one candidate, returned as in `mfm.model_fidelity_metric`"""
+        values = self.score_array(np.asarray(sim)[None, :])[0]
+        result = None if np.isnan(values).all() else tuple(float(v) for v in values)
+        return _format_result(result, MFMResult, MFM_COMPONENTS, return_type, out)
+
+    def score_many(self, sim):
+        """MFM of every row of an (n_candidates, n_time) array, as a DataFrame with the columns of MFM_COMPONENTS"""
+        import pandas as pd
+        return pd.DataFrame(self.score_array(sim), columns=MFM_COMPONENTS)
+
+    def score_array(self, sim):
+        """(n_candidates, len(MFM_COMPONENTS)) array of the MFM of every row of `sim`"""
+        sim = np.atleast_2d(_float_array(sim))
+        if sim.ndim != 2 or sim.shape[1] != len(self.obs):
+            raise ValueError(f'sim must have {len(self.obs)} values per row, got shape {sim.shape}')
+
+        result = np.full((sim.shape[0], len(MFM_COMPONENTS)), np.nan)
+        for start in range(0, sim.shape[0], self.chunk_size):
+            block = sim[start:start + self.chunk_size]
+            sim_clean = block if self.all_finite else block[:, self.mask]
+            fast = np.isfinite(sim_clean).all(axis=1)
+            if self.scorable and fast.any():
+                result[start + np.flatnonzero(fast)] = self._score_clean(sim_clean[fast])
+
+            # NaN values where obs is finite change the masked obs, so those rows are scored from scratch
+            slow = np.flatnonzero(~fast)
+            if len(slow):
+                result[start + slow] = _mfm_batch(block[slow], np.broadcast_to(self.obs, (len(slow), len(self.obs))),
+                                                  self.p, self.bins_suse, self.bins_phi, self.c, self.phase)
+        return result
+
+    def _obs_histograms(self, lo, hi, bins):
+        """obs histograms on each candidate's shared range, re-binned only for the ranges wider than obs"""
+        counts = np.repeat(self.obs_histograms[bins][None, :], len(lo), axis=0)
+        wider = np.flatnonzero((lo != self.obs_min) | (hi != self.obs_max))
+        if len(wider):
+            interior = np.linspace(lo[wider], hi[wider], bins + 1, axis=-1)[:, 1:-1].astype(self.obs.dtype, copy=False)
+            cumulative = np.searchsorted(self.obs_sorted, interior, side='left')
+            counts[wider] = np.diff(cumulative, axis=1, prepend=0, append=self.n)
+        return counts
+
+    def _score_clean(self, sim):
+        """MFM components of candidates without NaN on the obs mask, (n_rows, n) rows aligned with obs_clean"""
+        n_valid = np.full(len(sim), self.n)
+
+        # 1. Normalized error with phase penalty
+        error = np.subtract(sim, self.obs_clean)
+        np.abs(error, out=error)
+        if self.p != 1:
+            np.power(error, self.p, out=error)
+        nmaep = np.power(error.sum(axis=1, dtype=float) / self.n, 1 / self.p) / abs(self.mean_obs)
+        del error
+
+        phase_difference = None
+        if self.phase:
+            coefficient = sim @ self.twiddles
+            phase_sim = _dft_angle(coefficient[:, 0], coefficient[:, 1], np.abs(sim).sum(axis=1))
+            phase_difference = (phase_sim - self.phase_obs + np.pi) % (2 * np.pi) - np.pi
+
+        # 2. Variability capture and 3. Distribution similarity
+        sim_sorted = np.sort(sim, axis=1)
+        sim_min, sim_max = sim_sorted[:, 0], sim_sorted[:, -1]
+        lo = np.minimum(sim_min, self.obs_min)
+        hi = np.maximum(sim_max, self.obs_max)
+
+        hist_sim = _sorted_histograms(sim_sorted, n_valid, lo, hi, self.bins_suse)
+        hist_obs = self._obs_histograms(lo, hi, self.bins_suse)
+        Hs = np.abs(_row_entropy(hist_sim) - _row_entropy(hist_obs))
+        Hu_sim = np.where(sim_min == sim_max, 0.0,
+                          _row_entropy(_sorted_histograms(sim_sorted, n_valid, sim_min, sim_max, self.bins_suse)))
+        suse = np.where(lo == hi, 0.0, np.maximum(Hs, np.abs(Hu_sim - self.obs_entropy)))
+
+        if self.bins_phi != self.bins_suse:
+            hist_sim = _sorted_histograms(sim_sorted, n_valid, lo, hi, self.bins_phi)
+            hist_obs = self._obs_histograms(lo, hi, self.bins_phi)
+        phi = np.where(lo == hi, 1.0, np.minimum(hist_sim, hist_obs).sum(axis=1) / self.n)
+
+        return np.column_stack(_batch_components(nmaep, phase_difference, suse, phi, self.c))
@@ -0,0 +1,81 @@
+"""
+This script records where the time of metric calls goes, stage by stage.
+
+Stages (mask, NMAEp, PPF, SUSE, PHI, result, ...) are timed with `time.perf_counter_ns` and labelled with the
+current site. The events can be summarised as a table, per stage or per site and stage, or exported as Chrome
+trace-event JSON for chrome://tracing or Perfetto. When no profiler is attached, the metric functions use a
+shared no-op context instead, so instrumentation costs well under a microsecond per stage.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Shared no-op stage used when profiling is disabled
+NO_STAGE = contextlib.nullcontext()
+
+
+def no_stage(name):
+    return NO_STAGE
+
+
+class profiler:
+    def __init__(self):
+        self.events = []
+        self.current_site = None
+        self._origin = time.perf_counter_ns()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name` of the current site"""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.events.append((name, self.current_site, start, time.perf_counter_ns() - start))
+
+    @contextlib.contextmanager
+    def site(self, label):
+        """Label the stages of the enclosed block with site `label`"""
+        previous, self.current_site = self.current_site, label
+        try:
+            yield
+        finally:
+            self.current_site = previous
+
+    def reset(self):
+        self.events = []
+        return 0
+
+    def table(self, by_site=False):
+        """Calls, total, mean and share of the time of each stage (per site and stage with `by_site`)"""
+        import pandas as pd
+        events = pd.DataFrame(self.events, columns=['stage', 'site', 'start_ns', 'duration_ns'])
+        keys = ['site', 'stage'] if by_site else ['stage']
+        grouped = events.groupby(keys, sort=False, dropna=False)['duration_ns']
+        result = pd.DataFrame({
+            'calls': grouped.count(),
+            'total_ms': grouped.sum() / 1e6,
+            'mean_us': grouped.mean() / 1e3,
+            'max_us': grouped.max() / 1e3,
+        })
+        result['share'] = result['total_ms'] / result['total_ms'].sum()
+        return result
+
+    def trace_events(self):
+        """Chrome trace events ('X' complete events, microseconds) of the recorded stages"""
+        pid, tid = os.getpid(), threading.get_ident()
+        return [{'name': name, 'cat': 'mfm', 'ph': 'X', 'ts': (start - self._origin) / 1e3, 'dur': duration / 1e3,
+                 'pid': pid, 'tid': tid, 'args': {'site': site}}
+                for name, site, start, duration in self.events]
+
+    def write_trace(self, path):
+        """Write the events as Chrome trace-event JSON"""
+        print(f'\033[1;31mSaving {path}...\033[0m')
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+        print('\033[1;31mDone.\033[0m')
+
+        return 0
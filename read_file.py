@@ -1,25 +1,192 @@
 """
 This script is the file reader of CAMELS dataset.
+
+Model output files are fixed-width text, so only the byte columns of the date, MOD_RUN and OBS_RUN fields are
+parsed; files that are not fixed-width fall back to the pandas C whitespace parser. The parsed columns are
+cached in a `.npz` sidecar next to each file, keyed by the file size and modification time, so later reads
+skip text parsing altogether.
+
+A whole directory can be loaded into a store of memory-mapped (n_sites, n_days) sim and obs matrices aligned on
+a shared date index, so metric passes over all sites read the arrays directly instead of re-parsing text.
 """
 
+import os
+import re
 import numpy as np
 import pandas as pd
-import os
-from tqdm import tqdm
-from mfm import *
+from concurrent.futures import ProcessPoolExecutor
+from result_store import result_store, is_store
+
+# Columns kept from the model output files, and their names in the flow table
+FLOW_COLUMNS = {'YR': 'year', 'MNTH': 'month', 'DY': 'day', 'MOD_RUN': 'sim', 'OBS_RUN': 'obs'}
+
+_DATE_COLUMNS = ['year', 'month', 'day']
+
+# Model output files of a CAMELS directory, named <gauge>_05_model_output.txt
+MODEL_OUTPUT_PATTERN = re.compile(r'^(\d+)_05_model_output\.txt$')
+
+
+def flow_dates(year, month, day):
+    """datetime64[D] dates from year, month and day columns"""
+    months = (np.asarray(year, dtype=np.int64) - 1970) * 12 + np.asarray(month, dtype=np.int64) - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (np.asarray(day, dtype=np.int64) - 1)
+
+
+def _flow_task(args):
+    """Process-pool entry point: dates, sim and obs of one model output file"""
+    reader, file_path = args
+    flow = reader.read_flow(file_path)
+    return flow_dates(flow['year'], flow['month'], flow['day']), flow['sim'].to_numpy(), flow['obs'].to_numpy()
+
 
 class read_file:
-    def __init__(self):
+    def __init__(self, cache=True, dtype=np.float64):
+        """`cache` enables the .npz sidecar; `dtype` is the float type of sim and obs (np.float32 or np.float64)"""
+        self.cache = cache
+        self.dtype = dtype
+
         np.seterr(all='ignore')
 
-    def read_flow(self, file_path):
+    def read_flow(self, file_path, dtype=None):
         """Read single flow data file"""
-        data = pd.read_csv(file_path, sep=r'\s+', header=0)
-        result = data[['YR', 'MNTH', 'DY', 'MOD_RUN', 'OBS_RUN']]
-        result.columns = ['year', 'month', 'day', 'sim', 'obs']
-        return result
-
-    def read_result(self, result_path):
-        """Read result file"""
-        result = pd.read_csv(result_path, sep='\t', header=0)
-        return result
\ No newline at end of file
+        columns = self._read_cache(file_path) if self.cache else None
+        if columns is None:
+            columns = self._parse_fixed_width(file_path)
+            if columns is None:
+                columns = self._parse_whitespace(file_path)
+            if self.cache:
+                self._write_cache(file_path, columns)
+
+        dtype = self.dtype if dtype is None else dtype
+        return pd.DataFrame({name: columns[name].astype(int if name in _DATE_COLUMNS else dtype, copy=False)
+                             for name in FLOW_COLUMNS.values()})
+
+    def read_directory(self, directory, store_path, workers=1):
+        """Load every <gauge>_05_model_output.txt of `directory` into a memory-mapped store at `store_path`
+
+        Files are parsed in a process pool of `workers` (through the sidecar cache when present) and aligned on
+        the union of their dates; days missing from a file are NaN. The store holds gauge.npy, date.npy,
+        sim.npy and obs.npy, with sites sorted by gauge ID. Returns `open_store(store_path)`.
+        """
+        names = sorted(name for name in os.listdir(directory) if MODEL_OUTPUT_PATTERN.match(name))
+        if not names:
+            raise FileNotFoundError(f'No *_05_model_output.txt files in {directory}')
+        gauges = np.array([MODEL_OUTPUT_PATTERN.match(name).group(1) for name in names])
+        tasks = [(self, os.path.join(directory, name)) for name in names]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                flows = list(pool.map(_flow_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+        else:
+            flows = [_flow_task(task) for task in tasks]
+
+        # Shared date index: the union of all dates, as one contiguous daily range
+        first = min(dates[0] for dates, _, _ in flows)
+        last = max(dates[-1] for dates, _, _ in flows)
+        dates = np.arange(first, last + np.timedelta64(1, 'D'))
+
+        os.makedirs(store_path, exist_ok=True)
+        np.save(os.path.join(store_path, 'gauge.npy'), gauges)
+        np.save(os.path.join(store_path, 'date.npy'), dates)
+        for key, column in [('sim', 1), ('obs', 2)]:
+            store = np.lib.format.open_memmap(os.path.join(store_path, f'{key}.npy'), mode='w+', dtype=self.dtype,
+                                              shape=(len(gauges), len(dates)))
+            store[:] = np.nan
+            for i, flow in enumerate(flows):
+                store[i, (flow[0] - first).astype(np.int64)] = flow[column]
+            store.flush()
+            del store
+
+        return self.open_store(store_path)
+
+    def open_store(self, store_path, mode='r'):
+        """Open a store written by `read_directory`
+
+        Returns a dict with 'gauge' (pd.Index of gauge IDs), 'date' (pd.DatetimeIndex) and the memory-mapped
+        (n_sites, n_days) 'sim' and 'obs' arrays; use mode='r+' to modify them in place.
+        """
+        return {
+            'gauge': pd.Index(np.load(os.path.join(store_path, 'gauge.npy')), name='gauge'),
+            'date': pd.DatetimeIndex(np.load(os.path.join(store_path, 'date.npy')), name='date'),
+            'sim': np.load(os.path.join(store_path, 'sim.npy'), mmap_mode=mode),
+            'obs': np.load(os.path.join(store_path, 'obs.npy'), mmap_mode=mode),
+        }
+
+    def read_result(self, result_path, columns=None):
+        """Read result file, a tab-separated table or a `result_store` directory, keeping only `columns` if given"""
+        if is_store(result_path):
+            return result_store(result_path).table(columns)
+        result = pd.read_csv(result_path, sep='\t', header=0, usecols=columns)
+        return result if columns is None else result[list(columns)]
+
+    @staticmethod
+    def _parse_fixed_width(file_path):
+        """Parse the FLOW_COLUMNS of a fixed-width file from their byte columns, or None if it is not fixed-width"""
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        header_end = raw.index(b'\n') + 1
+        first_end = raw.find(b'\n', header_end) + 1
+        if first_end == 0:
+            return None
+        header = raw[:header_end].decode().split()
+        first = raw[header_end:first_end]
+        spans = [match.span() for match in re.finditer(rb'\S+', first)]
+        if len(spans) != len(header) or any(name not in header for name in FLOW_COLUMNS):
+            return None
+
+        # Every line must have the width of the first one and end with a newline
+        width = len(first)
+        body = raw[header_end:]
+        if len(body) % width:
+            return None
+        lines = np.frombuffer(body, dtype=np.uint8).reshape(-1, width)
+        if not np.all(lines[:, -1] == ord('\n')):
+            return None
+
+        columns = {}
+        for name, label in FLOW_COLUMNS.items():
+            i = header.index(name)
+            start = spans[i - 1][1] if i else 0
+            stop = spans[i][1]
+            # A field may extend left into the padding, but must not touch its neighbour
+            if i and not np.all(lines[:, start] == ord(' ')):
+                return None
+            field = np.full((len(lines), stop - start + 1), ord(' '), dtype=np.uint8)
+            field[:, :-1] = lines[:, start:stop]
+            values = np.array(field.tobytes().split(), dtype=float)
+            if len(values) != len(lines):
+                return None
+            columns[label] = values
+        return columns
+
+    @staticmethod
+    def _parse_whitespace(file_path):
+        """Parse the FLOW_COLUMNS of a whitespace-separated file with the pandas C parser"""
+        data = pd.read_csv(file_path, sep=r'\s+', header=0, usecols=list(FLOW_COLUMNS), dtype=float)
+        return {label: data[name].to_numpy() for name, label in FLOW_COLUMNS.items()}
+
+    @staticmethod
+    def _cache_key(file_path):
+        stat = os.stat(file_path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _read_cache(self, file_path):
+        """Columns from the sidecar cache, or None if it is missing or stale"""
+        try:
+            with np.load(f'{file_path}.npz') as cached:
+                if not np.array_equal(cached['key'], self._cache_key(file_path)):
+                    return None
+                return {label: cached[label] for label in FLOW_COLUMNS.values()}
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _write_cache(self, file_path, columns):
+        """Write the sidecar cache atomically; an unwritable data directory only disables caching"""
+        cache_path = f'{file_path}.npz'
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, key=self._cache_key(file_path), **columns)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
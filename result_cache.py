@@ -0,0 +1,121 @@
+"""
+This script is an on-disk cache of metric results, so repeated evaluations only pay for the sites that changed.
+
+Each result is keyed by a hash of the sim and obs bytes, the hyperparameters and `METRIC_VERSION`, and stored in
+a local SQLite database. When the stored results exceed `max_bytes`, the least recently used ones are evicted.
+The stored bytes and rows are kept in a meta table by triggers, so checking the size does not scan the results.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+from mfm_core import METRIC_VERSION, _float_array
+
+
+class result_cache:
+    def __init__(self, path='temp/mfm_cache.sqlite', max_bytes=256 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection = None
+
+    def __getstate__(self):
+        # Each process opens its own connection
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                     '(key BLOB PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            # The byte and row counts of the results, kept by triggers so every process updates them
+            self._connection.executescript('''
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN
+                    UPDATE meta SET value = value + LENGTH(NEW.key) + LENGTH(NEW.value) WHERE name = 'bytes';
+                    UPDATE meta SET value = value + 1 WHERE name = 'rows';
+                END;
+                CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF value ON results BEGIN
+                    UPDATE meta SET value = value + LENGTH(NEW.value) - LENGTH(OLD.value) WHERE name = 'bytes';
+                END;
+                CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN
+                    UPDATE meta SET value = value - LENGTH(OLD.key) - LENGTH(OLD.value) WHERE name = 'bytes';
+                    UPDATE meta SET value = value - 1 WHERE name = 'rows';
+                END;
+                INSERT OR IGNORE INTO meta
+                    SELECT 'bytes', COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM results;
+                INSERT OR IGNORE INTO meta SELECT 'rows', COUNT(*) FROM results;
+                COMMIT;
+            ''')
+        return self._connection
+
+    @staticmethod
+    def key(kind, sim, obs, params, backend='numpy'):
+        """Hash of the metric `kind`, the sim and obs values, the hyperparameters, METRIC_VERSION and the backend"""
+        digest = hashlib.blake2b(digest_size=20)
+        # Compiled results differ from the NumPy ones by rounding, so they are keyed apart (NumPy keys are unchanged)
+        header = (kind, METRIC_VERSION, tuple(params))
+        if backend != 'numpy':
+            header += (backend,)
+        digest.update(repr(header).encode())
+        for values in [sim, obs]:
+            values = np.ascontiguousarray(_float_array(values))
+            # float32 results differ slightly from float64 ones, so they are keyed apart (float64 keys are unchanged)
+            shape = values.shape if values.dtype == np.float64 else (values.shape, values.dtype.str)
+            digest.update(repr(shape).encode())
+            digest.update(values.tobytes())
+        return digest.digest()
+
+    def get_many(self, keys):
+        """Cached results of `keys`: a float array per hit (empty for an unscorable series), None per miss"""
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            query = f'SELECT key, value FROM results WHERE key IN ({",".join("?" * len(batch))})'
+            found.update(self.connection.execute(query, batch).fetchall())
+        if found:
+            now = time.time()
+            self.connection.executemany('UPDATE results SET last_used = ? WHERE key = ?',
+                                        [(now, key) for key in found])
+        return [np.frombuffer(found[key], dtype=float) if key in found else None for key in keys]
+
+    def put_many(self, keys, values):
+        """Store results (sequences of floats, or None for an unscorable series) and evict beyond max_bytes"""
+        now = time.time()
+        rows = [(key, b'' if value is None else np.asarray(value, dtype=float).tobytes(), now)
+                for key, value in zip(keys, values)]
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete would not fire the size trigger
+        self.connection.executemany('INSERT INTO results VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE '
+                                    'SET value = excluded.value, last_used = excluded.last_used', rows)
+        self.evict()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put(self, key, value):
+        self.put_many([key], [value])
+
+    def evict(self):
+        """Delete the least recently used results until the stored bytes fit in max_bytes"""
+        meta = dict(self.connection.execute('SELECT name, value FROM meta').fetchall())
+        total, count = meta['bytes'], meta['rows']
+        if total <= self.max_bytes:
+            return 0
+        excess = int(np.ceil((total - self.max_bytes) / (total / count)))
+        self.connection.execute('DELETE FROM results WHERE key IN '
+                                '(SELECT key FROM results ORDER BY last_used LIMIT ?)', (excess,))
+        return excess
+
+    def clear(self):
+        self.connection.execute('DELETE FROM results')
+        return 0
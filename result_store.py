@@ -0,0 +1,181 @@
+"""
+This script is a columnar store of long-format metric results (one row per site, metric and optionally model).
+
+A store is a directory of one .npy file per column, plus meta.json. Rows are sorted by site, GOF_stat and model.
+String columns such as GOF_stat and model are dictionary-encoded as small integer codes with their categories
+in meta.json. Statistic columns are float32, lat/lon stay float64 and CAMELS_site is int64. Two extra arrays
+index the rows:
+- site_start: the first row of each site, so a site's rows are one contiguous slice;
+- index: a dense (site, GOF_stat, model) array of row numbers, so any one row is a single lookup.
+
+Readers memory-map only the columns they are asked for, so hundreds of thousands of rows load in milliseconds.
+
+    result_store.write(result, 'temp/case_4_mfm.store')
+    store = result_store('temp/case_4_mfm.store')
+    store.table(columns=['CAMELS_site', 'GOF_stat', 'score'])      # column projection
+    store.stat('MFM', columns=['lat', 'lon', 'score'])             # every site of one metric
+    store.site(1013500)                                            # every metric of one site
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Version of the store layout
+STORE_VERSION = 1
+
+# Row keys, in sort order; 'model' is optional
+STORE_KEYS = ['CAMELS_site', 'GOF_stat', 'model']
+
+# Columns kept in float64 rather than float32
+FLOAT64_COLUMNS = ['lat', 'lon']
+
+
+def is_store(path):
+    """Whether `path` is a directory written by `result_store.write`"""
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class result_store:
+    def __init__(self, path, mmap=True):
+        """Open the store at `path`; with `mmap=True` columns are memory-mapped rather than read"""
+        self.path = path
+        self.mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise ValueError(f'{path} is a version {meta["version"]} store, expected version {STORE_VERSION}')
+        self.columns = meta['columns']
+        self.categories = meta['categories']
+        self.keys = meta['keys']
+        self.n_rows = meta['n_rows']
+
+        self.sites = self._load('site')
+        self.site_start = self._load('site_start')
+        self._index = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode=self.mmap_mode)
+
+    @property
+    def index(self):
+        """(n_sites, n_stats[, n_models]) row numbers, -1 where a combination is missing"""
+        if self._index is None:
+            self._index = self._load('index')
+        return self._index
+
+    def codes(self, name):
+        """Integer codes of a dictionary-encoded column"""
+        return self._load(name)
+
+    def column(self, name, rows=None):
+        """Values of one column (for `rows`, a slice or row numbers), categorical columns as pd.Categorical"""
+        if name not in self.columns:
+            raise KeyError(f'{name!r} is not a column of {self.path}, expected one of {self.columns}')
+        values = self._load(name)
+        values = values if rows is None else values[rows]
+        if name in self.categories:
+            return pd.Categorical.from_codes(values, categories=self.categories[name])
+        return values
+
+    def table(self, columns=None, rows=None):
+        """DataFrame of `columns` (default: all), reading only those columns"""
+        columns = self.columns if columns is None else list(columns)
+        return pd.DataFrame({name: self.column(name, rows) for name in columns})
+
+    def _site_position(self, site):
+        position = int(np.searchsorted(self.sites, site))
+        if position == len(self.sites) or self.sites[position] != site:
+            raise KeyError(f'Site {site} is not in {self.path}')
+        return position
+
+    def _code(self, name, value):
+        if value not in self.categories[name]:
+            raise KeyError(f'{value!r} is not a {name} of {self.path}, expected one of {self.categories[name]}')
+        return self.categories[name].index(value)
+
+    def site(self, site, columns=None):
+        """Rows of one site, as a DataFrame of `columns`"""
+        position = self._site_position(site)
+        return self.table(columns, slice(int(self.site_start[position]), int(self.site_start[position + 1])))
+
+    def stat(self, stat, columns=None, model=None):
+        """Rows of one GOF_stat (and `model`, for stores with a model column) for every site that has it"""
+        rows = self.index[:, self._code('GOF_stat', stat)]
+        if 'model' in self.keys:
+            rows = rows[:, self._code('model', model)] if model is not None else rows.ravel()
+        return self.table(columns, rows[rows >= 0])
+
+    def row(self, site, stat, model=None):
+        """One row, as a pd.Series"""
+        key = (self._site_position(site), self._code('GOF_stat', stat))
+        if 'model' in self.keys:
+            key += (self._code('model', model),)
+        row = int(self.index[key])
+        if row < 0:
+            raise KeyError(f'No row for {key} in {self.path}')
+        return self.table(rows=[row]).iloc[0]
+
+    @staticmethod
+    def write(result, path):
+        """Write a long-format DataFrame (CAMELS_site, GOF_stat, optionally model, and any other columns)
+
+        The store is written next to `path` and then moved in place, so readers never see a partial store. An
+        existing store at `path` is replaced; any other existing file or directory is refused.
+        """
+        if os.path.exists(path) and not is_store(path):
+            raise ValueError(f'{path} exists and is not a result store, refusing to overwrite it')
+        missing = [key for key in STORE_KEYS[:2] if key not in result.columns]
+        if missing:
+            raise ValueError(f'result must have the columns {missing}')
+        keys = [key for key in STORE_KEYS if key in result.columns]
+        if result.duplicated(keys).any():
+            raise ValueError(f'result has duplicate {keys} rows')
+
+        print(f'\033[1;31mSaving {path}...\033[0m')
+        site = result['CAMELS_site'].to_numpy().astype(np.int64)
+        categories, codes = {}, {}
+        for name in result.columns:
+            values = result[name]
+            if name != 'CAMELS_site' and not pd.api.types.is_numeric_dtype(values):
+                code, unique = pd.factorize(values.astype(str), sort=False)
+                categories[name] = [str(value) for value in unique]
+                codes[name] = code.astype(np.int8 if len(unique) < 2 ** 7 else np.int32)
+
+        order = np.lexsort([codes[key] for key in reversed(keys[1:])] + [site])
+        site = site[order]
+        sites, site_start = np.unique(site, return_index=True)
+        index = np.full((len(sites),) + tuple(len(categories[key]) for key in keys[1:]), -1, dtype=np.int32)
+        index[(np.searchsorted(sites, site),) + tuple(codes[key][order] for key in keys[1:])] = np.arange(len(site))
+
+        # A temporary directory per process, so concurrent writers never share one before the rename
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for name in result.columns:
+            if name == 'CAMELS_site':
+                values = site
+            elif name in codes:
+                values = codes[name][order]
+            else:
+                values = result[name].to_numpy()[order]
+                if values.dtype.kind == 'f':
+                    values = values.astype(np.float64 if name in FLOAT64_COLUMNS else np.float32)
+            np.save(os.path.join(temp_path, f'{name}.npy'), np.ascontiguousarray(values))
+        np.save(os.path.join(temp_path, 'site.npy'), sites)
+        np.save(os.path.join(temp_path, 'site_start.npy'), np.append(site_start, len(site)))
+        np.save(os.path.join(temp_path, 'index.npy'), index)
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': STORE_VERSION, 'columns': list(result.columns), 'categories': categories,
+                       'keys': keys, 'n_rows': len(site)}, f, indent=1)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        print('\033[1;31mDone.\033[0m')
+
+        return 0
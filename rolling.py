@@ -0,0 +1,193 @@
+"""
+This script calculates MFM per sliding window and per water year, to locate when a model degrades.
+
+Sliding windows are updated incrementally instead of rescoring every slice:
+- the error norm and obs mean come from running (prefix) sums,
+- the spectra PPF needs come from a sliding DFT, S(i + 1) = S(i) + (x[i + W] - x[i]) * w^(k i), anchored by one
+  real FFT per block of windows so rounding cannot drift,
+- the histogram edges follow each window's own min/max, which only change when an extreme enters or leaves the
+  window. Within a run of consecutive windows sharing their edges, counts are updated by adding the sample that
+  enters and removing the one that leaves; only the first window of each run is sorted and counted.
+A window therefore costs O(bins + W / 2) (the sliding DFT updates every bin, since the dominant frequency is the
+largest of them) plus O(W log W) at each change of a min/max, instead of O(W log W) for every window.
+Windows containing masked (NaN) values are scored directly, since masking shifts the positions of the DFT.
+When several obs frequencies tie exactly for the largest amplitude (e.g. a window with a single non-zero day),
+rounding may pick a different one of them than a direct FFT would.
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from mfm_core import (MFM_COMPONENTS, water_years, _twiddle, _dft_angle, _sorted_histograms, _batch_suse, _batch_phi,
+                      _batch_components, _mfm_batch, _block_layout, _replicate_indices)
+
+
+def _sliding_histograms(values, window_starts, window, lo, hi, bins):
+    """Histogram counts of each window on np.linspace(lo, hi, bins + 1) edges, as `_sorted_histograms` counts
+
+    A run starts wherever a window does not follow the previous one by one sample or has other edges. The first
+    window of a run is sorted and counted; each later one adds the bin of its entering sample and removes the
+    bin of the sample that left, and the counts are the running sums of those updates within the run.
+    """
+    interior = np.linspace(lo, hi, bins + 1, axis=-1)[:, 1:-1]
+    run_start = np.ones(len(window_starts), dtype=bool)
+    run_start[1:] = (np.diff(window_starts) != 1) | (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    first = np.flatnonzero(run_start)
+    update = np.flatnonzero(~run_start)
+
+    counts = np.zeros((len(window_starts), bins), dtype=np.int64)
+    first_sorted = np.sort(sliding_window_view(values, window)[window_starts[first]], axis=1)
+    counts[first] = _sorted_histograms(first_sorted, np.full(len(first), window), lo[first], hi[first], bins)
+    for sample, sign in [(window_starts[update] + window - 1, 1), (window_starts[update] - 1, -1)]:
+        # Bin of one value per window: the number of that window's interior edges at or below it
+        bin_index = np.sum(interior[update] <= values[sample][:, None], axis=1)
+        np.add.at(counts, (update, bin_index), sign)
+
+    cumulative = np.cumsum(counts, axis=0)
+    return cumulative - (cumulative[first] - counts[first])[np.cumsum(run_start) - 1]
+
+
+class rolling:
+    def __init__(self, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, block_elements=2 ** 21):
+        self.p = p
+        self.bins_suse = bins_suse
+        self.bins_phi = bins_phi
+        self.c = c
+        self.phase = phase
+        self.block_elements = block_elements
+
+        np.seterr(all='ignore')
+
+    def sliding(self, sim, obs, window=365, step=1):
+        """Calculate MFM of every `window`-sample slice, moving by `step` samples
+
+        Returns a DataFrame with the `MFM_COMPONENTS` columns, indexed by the label of the last sample of each
+        window (the index of `obs` when it is a pandas Series, otherwise the sample position).
+        """
+        labels = obs.index if isinstance(obs, pd.Series) else pd.RangeIndex(len(obs))
+        sim = np.asarray(sim, dtype=float)
+        obs = np.asarray(obs, dtype=float)
+        starts = np.arange(0, len(obs) - window + 1, step)
+        result = np.full((len(starts), len(MFM_COMPONENTS)), np.nan)
+        if len(starts) == 0 or window < 3:
+            return pd.DataFrame(result, columns=MFM_COMPONENTS, index=labels[:0])
+
+        # Running sums over the windows, with masked samples counted separately
+        mask = np.isfinite(sim) & np.isfinite(obs)
+        error = np.power(np.abs(np.where(mask, sim - obs, 0.0)), self.p)
+
+        def window_sums(values):
+            cumulative = np.concatenate(([0.0], np.cumsum(values)))
+            return cumulative[starts + window] - cumulative[starts]
+
+        complete = window_sums(~mask) == 0
+        obs_sum = window_sums(np.where(mask, obs, 0.0))
+        error_sum = window_sums(error)
+
+        # Windows with masked values are scored directly
+        partial = np.flatnonzero(~complete)
+        if len(partial):
+            rows = starts[partial][:, None] + np.arange(window)
+            result[partial] = _mfm_batch(sim[rows], obs[rows], self.p, self.bins_suse, self.bins_phi, self.c,
+                                         self.phase)
+
+        n_freq = window // 2 + 1
+        block = max(1, self.block_elements // (max(n_freq, window) * step))
+        sim_windows = sliding_window_view(sim, window)
+        obs_windows = sliding_window_view(obs, window)
+        for start in range(0, len(starts), block):
+            rows = np.arange(start, min(start + block, len(starts)))
+            rows = rows[complete[rows]]
+            rows = rows[obs_sum[rows] != 0]
+            if len(rows) == 0:
+                continue
+            window_starts = starts[rows]
+
+            nmaep = np.power(error_sum[rows] / window, 1 / self.p) / np.abs(obs_sum[rows] / window)
+            phase_difference = self._phase_difference(sim, obs, window_starts, window) if self.phase else None
+
+            sim_range = sim_windows[window_starts].min(axis=1), sim_windows[window_starts].max(axis=1)
+            obs_range = obs_windows[window_starts].min(axis=1), obs_windows[window_starts].max(axis=1)
+            lo, hi = np.minimum(sim_range[0], obs_range[0]), np.maximum(sim_range[1], obs_range[1])
+
+            def histograms(v_range, bins):
+                return tuple(_sliding_histograms(values, window_starts, window, *value_range, bins)
+                             for values, value_range in [(sim, v_range[0]), (obs, v_range[1])])
+
+            state = {
+                'n_valid': np.full(len(rows), window),
+                'sim_range': sim_range,
+                'obs_range': obs_range,
+                'lo': lo,
+                'hi': hi,
+                'scaled_histograms': {bins: histograms(((lo, hi), (lo, hi)), bins)
+                                      for bins in {self.bins_suse, self.bins_phi}},
+                'unscaled_histograms': {self.bins_suse: histograms((sim_range, obs_range), self.bins_suse)},
+            }
+            result[rows] = np.column_stack(_batch_components(
+                nmaep, phase_difference, _batch_suse(state, self.bins_suse), _batch_phi(state, self.bins_phi), self.c))
+
+        return pd.DataFrame(result, columns=MFM_COMPONENTS,
+                            index=labels[starts + window - 1].rename('window_end'))
+
+    def _phase_difference(self, sim, obs, window_starts, window):
+        """PPF phase difference of complete windows starting at `window_starts`"""
+        # Samples are taken from the first window on. Masked samples between the windows are zeroed: they
+        # enter and leave the running sums without reaching a complete window, so they must not turn them NaN
+        span = slice(window_starts[0], window_starts[-1] + window)
+        sim, obs = (np.where(np.isfinite(values[span]), values[span], 0.0) for values in (sim, obs))
+        window_starts = window_starts - window_starts[0]
+        if window_starts[-1] > np.log2(window) * len(window_starts):
+            # Sparse windows: a direct FFT of each is cheaper than sliding over every sample in between
+            spectrum_obs = np.fft.rfft(sliding_window_view(obs, window)[window_starts], axis=1)
+            spectrum_sim = np.fft.rfft(sliding_window_view(sim, window)[window_starts], axis=1)
+        else:
+            spectrum_obs = self._sliding_spectrum(obs, window_starts, window)
+            spectrum_sim = self._sliding_spectrum(sim, window_starts, window)
+
+        amplitude = np.abs(spectrum_obs[:, 1:window // 2 + 1])
+        dominant_freq_idx = np.argmax(amplitude, axis=1)
+        if window > 365:
+            dominant_freq_idx = np.maximum(dominant_freq_idx, 33)
+        dominant_freq_idx += 1
+
+        def abs_sums(values):
+            cumulative = np.concatenate(([0.0], np.cumsum(np.abs(values[:window_starts[-1] + window]))))
+            return cumulative[window_starts + window] - cumulative[window_starts]
+
+        take = np.arange(len(window_starts))
+        coefficient_obs = spectrum_obs[take, dominant_freq_idx]
+        coefficient_sim = spectrum_sim[take, dominant_freq_idx]
+        phase_obs = _dft_angle(coefficient_obs.real, coefficient_obs.imag, abs_sums(obs))
+        phase_sim = _dft_angle(coefficient_sim.real, coefficient_sim.imag, abs_sums(sim))
+        return (phase_sim - phase_obs + np.pi) % (2 * np.pi) - np.pi
+
+    @staticmethod
+    def _sliding_spectrum(values, window_starts, window):
+        """Real-FFT spectra of the windows starting at `window_starts`, by a sliding DFT anchored at the first"""
+        first = window_starts[0]
+        k = np.arange(window // 2 + 1)
+
+        # S_k(i) = sum over the window starting at i of x[j] * w^(k j); the window spectrum is w^(-k i) * S_k(i).
+        # w^(k j) only depends on j mod window, so one (window, n_freq) table serves every sample
+        cos_t, sin_t = _twiddle((np.arange(window)[:, None] * k[None, :]) % window, window)
+        twiddle = cos_t - 1j * sin_t
+        j = first + np.arange(window_starts[-1] - first)
+        anchor = np.fft.rfft(values[first:first + window]) * twiddle[first % window]
+        increment = values[j + window] - values[j]
+        running = np.vstack([anchor, anchor + np.cumsum(increment[:, None] * twiddle[j % window], axis=0)])
+
+        return running[window_starts - first] * np.conj(twiddle[window_starts % window])
+
+    def by_water_year(self, sim, obs, year, month):
+        """Calculate MFM of each water year (October to September), indexed by water year"""
+        sim = np.asarray(sim, dtype=float)
+        obs = np.asarray(obs, dtype=float)
+        blocks = water_years(year, month)
+        order, start, length = _block_layout(blocks)
+        index = _replicate_indices(np.arange(len(start))[:, None], order, start, length)
+        padding = index < 0
+        result = _mfm_batch(np.where(padding, np.nan, sim[index]), np.where(padding, np.nan, obs[index]),
+                            self.p, self.bins_suse, self.bins_phi, self.c, self.phase)
+        return pd.DataFrame(result, columns=MFM_COMPONENTS,
+                            index=pd.Index(np.unique(blocks), name='water_year'))
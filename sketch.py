@@ -0,0 +1,215 @@
+"""
+This script approximates MFM from a fixed-size, mergeable sketch, for screening very large series.
+
+A sketch keeps everything NMAEp needs exactly (count, obs sum, error-norm sum) and the exact min/max of sim and
+obs. It also keeps a uniform random sample of `size` jointly finite (sim, obs) pairs. The sample is the `size`
+pairs with the smallest random keys, so two sketches merge into the sketch of their concatenated data. Chunks
+and workers can therefore be sketched apart and merged in any order. SUSE and PHI are estimated from the sample
+on the exact ranges.
+
+Each estimate comes with an error bound at the given `confidence`. The bounds are normal-approximation
+intervals from the per-pair influence of each estimate (delta method), with the finite-population correction
+and the plug-in entropy bias (bins - 1) / (2 * size). They are 0 when the sample holds every pair. NMAEp is
+exact, and so is PPF, which is computed from the full series in `approximate` or supplied to `estimate`.
+
+    sk = sketch(size=2 ** 16, seed=0)
+    for sim_chunk, obs_chunk in chunks:
+        sk.update(sim_chunk, obs_chunk)
+    values, bounds = sk.merge(other_worker_sketch).estimate()
+"""
+
+import math
+from statistics import NormalDist
+import numpy as np
+from mfm_core import _float_array, _row_entropy, _block_phase_difference, _batch_components
+
+# Sample size of the pilot sketch that sizes the sample for a tolerance
+PILOT_SIZE = 4096
+
+
+def _bin_index(values, lo, hi, bins):
+    """Bin of each value on np.linspace(lo, hi, bins + 1) edges, as np.histogram assigns them"""
+    interior = np.linspace(lo, hi, bins + 1)[1:-1]
+    return np.searchsorted(interior, values, side='right')
+
+
+class sketch:
+    def __init__(self, p=1, size=2 ** 16, seed=None):
+        """`size` pairs are sampled; `seed` seeds the sample keys (give merged sketches different seeds)"""
+        self.p = p
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+
+        self.n = 0
+        self.obs_sum = 0.0
+        self.error_sum = 0.0
+        self.sim_min = self.obs_min = np.inf
+        self.sim_max = self.obs_max = -np.inf
+        self.keys = np.empty(0)
+        self.sim = np.empty(0)
+        self.obs = np.empty(0)
+
+        np.seterr(all='ignore')
+
+    def update(self, sim, obs):
+        """Add a chunk of sim and obs values (NaN values are masked jointly) and return the sketch"""
+        sim, obs = _float_array(sim), _float_array(obs)
+        mask = np.isfinite(sim) & np.isfinite(obs)
+        if not mask.all():
+            sim, obs = sim[mask], obs[mask]
+        k = len(sim)
+        if k == 0:
+            return self
+
+        self.n += k
+        self.obs_sum += float(np.sum(obs, dtype=float))
+        self.error_sum += float(np.sum(np.power(np.abs(sim - obs), self.p), dtype=float))
+        self.sim_min, self.sim_max = min(self.sim_min, float(np.min(sim))), max(self.sim_max, float(np.max(sim)))
+        self.obs_min, self.obs_max = min(self.obs_min, float(np.min(obs))), max(self.obs_max, float(np.max(obs)))
+        self._sample(sim, obs)
+        return self
+
+    def _sample(self, sim, obs):
+        """Add jointly finite pairs to the sample only"""
+        k = len(sim)
+        if k > self.size:
+            # The `size` smallest of k uniform keys: a uniform subset, with keys uniform below the next order
+            # statistic, which is Beta(size + 1, k - size) distributed
+            index = np.sort(self.rng.choice(k, self.size, replace=False))
+            keys = self.rng.beta(self.size + 1, k - self.size) * self.rng.random(self.size)
+            sim, obs = sim[index], obs[index]
+        else:
+            keys = self.rng.random(k)
+        self._keep(keys, sim, obs)
+
+    def resample(self, sim, obs, size, seed=None):
+        """Sketch of `size` pairs of the data this sketch was built from, reusing its exact statistics"""
+        sim, obs = _float_array(sim), _float_array(obs)
+        mask = np.isfinite(sim) & np.isfinite(obs)
+        if not mask.all():
+            sim, obs = sim[mask], obs[mask]
+        if len(sim) != self.n:
+            raise ValueError(f'resample needs the {self.n} pairs this sketch was built from, got {len(sim)}')
+        other = sketch(self.p, size, seed)
+        other.n, other.obs_sum, other.error_sum = self.n, self.obs_sum, self.error_sum
+        other.sim_min, other.sim_max = self.sim_min, self.sim_max
+        other.obs_min, other.obs_max = self.obs_min, self.obs_max
+        other._sample(sim, obs)
+        return other
+
+    def merge(self, other):
+        """Add the data of another sketch of the same p and return this sketch"""
+        if other.p != self.p:
+            raise ValueError(f'Cannot merge sketches of p={self.p} and p={other.p}')
+        self.n += other.n
+        self.obs_sum += other.obs_sum
+        self.error_sum += other.error_sum
+        self.sim_min, self.sim_max = min(self.sim_min, other.sim_min), max(self.sim_max, other.sim_max)
+        self.obs_min, self.obs_max = min(self.obs_min, other.obs_min), max(self.obs_max, other.obs_max)
+        self.size = min(self.size, other.size)
+        self._keep(other.keys, other.sim, other.obs)
+        return self
+
+    def _keep(self, keys, sim, obs):
+        """Keep the `size` pairs with the smallest keys out of the sample and the new pairs"""
+        keys = np.concatenate([self.keys, keys])
+        sim = np.concatenate([self.sim, sim])
+        obs = np.concatenate([self.obs, obs])
+        if len(keys) > self.size:
+            kept = np.argpartition(keys, self.size)[:self.size]
+            keys, sim, obs = keys[kept], sim[kept], obs[kept]
+        self.keys, self.sim, self.obs = keys, sim, obs
+
+    def estimate(self, bins_suse=10, bins_phi=10, c=4, phase_difference=None, confidence=0.95):
+        """(values, bounds) of MFM_COMPONENTS, each a tuple of floats
+
+        `phase_difference` is the exact PPF phase difference in radians; without it PPF is NaN and omega is
+        exp(- NMAEp), as with phase=False. Returns (None, None) for data that cannot be scored.
+        """
+        if self.n < 3 or self.obs_sum == 0:
+            return None, None
+        nmaep = (self.error_sum / self.n) ** (1 / self.p) / abs(self.obs_sum / self.n)
+        suse, suse_bound, phi, phi_bound = self._histogram_components(bins_suse, bins_phi, confidence)
+        values = tuple(float(v) for v in _batch_components(nmaep, phase_difference, suse, phi, c))
+
+        # exp(-x) changes by at most b * exp(-(x - b)) over [x - b, x + b], and MFM by the norm of its terms
+        varphi_bound = min(1.0, suse_bound * math.exp(-max(suse - suse_bound, 0.0)))
+        mfm_bound = math.sqrt((varphi_bound ** 2 + phi_bound ** 2) / 3)
+        bounds = (mfm_bound, 0.0, 0.0, 0.0, varphi_bound, phi_bound)
+        return values, bounds
+
+    def _histogram_components(self, bins_suse, bins_phi, confidence):
+        """SUSE and PHI estimated from the sample on the exact ranges, with their bounds"""
+        min_val, max_val = min(self.sim_min, self.obs_min), max(self.sim_max, self.obs_max)
+        if min_val == max_val:
+            return 0.0, 0.0, 1.0, 0.0
+
+        m = len(self.keys)
+        scale = NormalDist().inv_cdf((1 + confidence) / 2) * math.sqrt(max(0.0, 1 - m / self.n) / m)
+        exact = m == self.n
+
+        def entropy_difference(lo_sim, hi_sim, lo_obs, hi_obs):
+            """Entropy difference of the sim and obs histograms, and the spread of its per-pair influence"""
+            if lo_sim == hi_sim and lo_obs == hi_obs:
+                return 0.0, 0.0
+            influence = np.zeros(m)
+            entropy = []
+            for values, lo, hi, sign in [(self.sim, lo_sim, hi_sim, 1), (self.obs, lo_obs, hi_obs, -1)]:
+                if lo == hi:
+                    entropy.append(0.0)
+                    continue
+                index = _bin_index(values, lo, hi, bins_suse)
+                counts = np.bincount(index, minlength=bins_suse)
+                entropy.append(float(_row_entropy(counts[None, :])[0]))
+                influence -= sign * np.log(counts[index] / m)
+            return entropy[0] - entropy[1], float(np.std(influence))
+
+        scaled, scaled_spread = entropy_difference(min_val, max_val, min_val, max_val)
+        unscaled, unscaled_spread = entropy_difference(self.sim_min, self.sim_max, self.obs_min, self.obs_max)
+        suse = max(abs(scaled), abs(unscaled))
+        suse_bound = 0.0 if exact else scale * max(scaled_spread, unscaled_spread) + (bins_suse - 1) / (2 * m)
+
+        # PHI is the sample mean of the indicator that a pair's sim (or obs) lies in a bin where sim (or obs) is
+        # the smaller histogram
+        sim_index = _bin_index(self.sim, min_val, max_val, bins_phi)
+        obs_index = _bin_index(self.obs, min_val, max_val, bins_phi)
+        sim_smaller = np.bincount(sim_index, minlength=bins_phi) < np.bincount(obs_index, minlength=bins_phi)
+        indicator = sim_smaller[sim_index].astype(float) + ~sim_smaller[obs_index]
+        phi = float(np.mean(indicator))
+        phi_bound = 0.0 if exact else min(1.0, scale * float(np.std(indicator)))
+        return suse, suse_bound, phi, phi_bound
+
+
+def approximate(sim, obs, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, tolerance=0.01, confidence=0.95,
+                seed=0):
+    """(values, bounds) of MFM_COMPONENTS from a sample sized so the MFM bound is about `tolerance`
+
+    A pilot sketch of PILOT_SIZE pairs measures how the bound shrinks with the sample size, and the sample
+    is sized from it (every pair for tolerance=0, which is exact). PPF is computed from the full series.
+    Returns (None, None) for data that cannot be scored.
+    """
+    sim, obs = _float_array(sim), _float_array(obs)
+    mask = np.isfinite(sim) & np.isfinite(obs)
+    if not mask.all():
+        sim, obs = sim[mask], obs[mask]
+    n = len(sim)
+    if n < 3:
+        return None, None
+
+    seeds = np.random.SeedSequence(seed).spawn(2)
+    pilot = sketch(p, min(n, PILOT_SIZE), seeds[0]).update(sim, obs)
+    pilot_bound = pilot.estimate(bins_suse, bins_phi, c, None, confidence)[1]
+    if pilot_bound is None:
+        return None, None
+
+    # The bound scales as sqrt(1 / m - 1 / n): solve spread^2 * (1 / m - 1 / n) = tolerance^2 for m
+    m = size = len(pilot.keys)
+    spread = pilot_bound[0] / math.sqrt(1 / m - 1 / n) if m < n else 0.0
+    if tolerance <= 0:
+        size = n
+    elif spread > 0:
+        size = min(n, max(m, math.ceil(1 / ((tolerance / spread) ** 2 + 1 / n))))
+
+    full = pilot if size == m else pilot.resample(sim, obs, size, seeds[1])
+    phase_difference = float(_block_phase_difference(sim[None, :], obs[None, :])[0]) if phase else None
+    return full.estimate(bins_suse, bins_phi, c, phase_difference, confidence)
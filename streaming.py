@@ -0,0 +1,190 @@
+"""
+This script calculates MFM from chunked input, for series too large to hold in memory.
+
+Two passes are made over the chunks. The first accumulates the sample count, the min/max of sim and obs, the
+obs sum and the error-norm sum. The second accumulates the PHI and SUSE histogram counts on the ranges found in
+the first pass, and the DFT coefficients PPF needs. NaN values are masked jointly as in
+`mfm.model_fidelity_metric`, and DFT positions count only the unmasked samples, as in the compacted series.
+"""
+
+import numpy as np
+import pandas as pd
+from mfm_core import MFM_COMPONENTS, _twiddle, _dft_angle, _row_entropy, _batch_components
+
+# Frequencies and samples per block of the band DFT, which bound its twiddle matrices (256 x 1024)
+FREQ_BLOCK = 256
+TIME_BLOCK = 1024
+
+
+def _band_dft(rows, freq_idx, n, position):
+    """DFT coefficients at `freq_idx` of an (n_rows, k) chunk starting at sample `position` of an n-sample series
+
+    The chunk is split into TIME_BLOCK-sample blocks. Within a block, the twiddles only depend on the offset
+    from the block start, so for each FREQ_BLOCK frequencies one twiddle matrix serves every block as a matrix
+    product; each block is then rotated to its start. Memory is bounded by the chunk and the block sizes.
+    """
+    n_rows, k = rows.shape
+    n_blocks = -(-k // TIME_BLOCK)
+    blocks = np.zeros((n_rows, n_blocks * TIME_BLOCK))
+    blocks[:, :k] = rows
+    blocks = blocks.reshape(n_rows * n_blocks, TIME_BLOCK).T
+    offset = np.arange(TIME_BLOCK)
+    block_start = position + TIME_BLOCK * np.arange(n_blocks)
+    result = np.zeros((n_rows, len(freq_idx)), dtype=complex)
+    for start in range(0, len(freq_idx), FREQ_BLOCK):
+        freq = freq_idx[start:start + FREQ_BLOCK, None]
+        cos_t, sin_t = _twiddle((freq * offset) % n, n)
+        within = ((cos_t @ blocks) - 1j * (sin_t @ blocks)).reshape(len(freq), n_rows, n_blocks)
+        cos_r, sin_r = _twiddle((freq * block_start) % n, n)
+        rotation = (cos_r - 1j * sin_r)[:, None, :]
+        result[:, start:start + FREQ_BLOCK] = np.sum(within * rotation, axis=2).T
+    return result
+
+
+class streaming:
+    def __init__(self, chunk_size=1000000):
+        self.chunk_size = chunk_size
+
+        np.seterr(all='ignore')
+
+    def from_arrays(self, sim, obs):
+        """Chunk source over array-likes such as np.memmap, read `chunk_size` samples at a time"""
+        def chunks():
+            for start in range(0, len(obs), self.chunk_size):
+                yield (np.asarray(sim[start:start + self.chunk_size], dtype=float),
+                       np.asarray(obs[start:start + self.chunk_size], dtype=float))
+        return chunks
+
+    def from_file(self, file_path, sim_column='MOD_RUN', obs_column='OBS_RUN'):
+        """Chunk source over a whitespace-separated model output file"""
+        def chunks():
+            reader = pd.read_csv(file_path, sep=r'\s+', header=0, usecols=[sim_column, obs_column],
+                                 chunksize=self.chunk_size)
+            for data in reader:
+                yield data[sim_column].to_numpy(dtype=float), data[obs_column].to_numpy(dtype=float)
+        return chunks
+
+    def model_fidelity_metric(self, chunks, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, freq_band=None):
+        """Calculate MFM in two passes over `chunks`, a callable returning a fresh iterable of (sim, obs) chunks
+
+        By default the masked obs series is kept for one real FFT, so the dominant frequency is found exactly as
+        in the in-memory function. This mode is not memory-bounded: it holds the whole obs series (8 bytes per
+        sample) and its spectrum. With `freq_band=(f_min, f_max)` in cycles per sample, the dominant frequency
+        is searched among the DFT bins in that band only (then raised to bin 34 for series over 365 samples, as
+        in the in-memory function). Those bins are accumulated chunk by chunk in fixed-size blocks, so memory
+        stays bounded by the chunk size; time grows with the number of band bins times the series length.
+        """
+        # First pass: count, ranges, obs mean and error norm
+        n = 0
+        obs_sum = 0.0
+        error_sum = 0.0
+        sim_min = obs_min = np.inf
+        sim_max = obs_max = -np.inf
+        obs_parts = []
+        for sim, obs in chunks():
+            sim, obs = self._clean(sim, obs)
+            if len(sim) == 0:
+                continue
+            n += len(sim)
+            obs_sum += np.sum(obs)
+            error_sum += np.sum(np.power(np.abs(sim - obs), p))
+            sim_min, sim_max = min(sim_min, np.min(sim)), max(sim_max, np.max(sim))
+            obs_min, obs_max = min(obs_min, np.min(obs)), max(obs_max, np.max(obs))
+            if phase and freq_band is None:
+                obs_parts.append(obs)
+
+        if n < 3 or obs_sum == 0:
+            return np.nan
+        mean_obs = obs_sum / n
+        nmaep = np.power(error_sum / n, 1 / p) / abs(mean_obs)
+
+        # Dominant frequency candidates of the masked series
+        freq_idx = None
+        phase_obs = None
+        if phase and freq_band is None:
+            obs = np.concatenate(obs_parts)
+            del obs_parts
+            fft_obs = np.fft.rfft(obs)
+            freq_idx = np.array([self._dominant_freq_idx(np.abs(fft_obs[1:n // 2 + 1]), n)])
+            coefficient = fft_obs[freq_idx[0]]
+            phase_obs = _dft_angle(coefficient.real, coefficient.imag, np.sum(np.abs(obs)))
+            del obs, fft_obs
+        elif phase:
+            band_idx = np.arange(max(1, int(np.ceil(freq_band[0] * n))), min(n // 2, int(freq_band[1] * n)) + 1)
+            if len(band_idx) == 0:
+                raise ValueError(f'freq_band {freq_band} holds no DFT bin of a {n}-sample series')
+            # Bin 34 is the floor of the dominant frequency of long series, so it is accumulated too
+            freq_idx = np.union1d(band_idx, [34]) if n > 365 else band_idx
+
+        # Second pass: histograms on the global ranges and DFT coefficients
+        min_val, max_val = min(sim_min, obs_min), max(sim_max, obs_max)
+        edges = {
+            'scaled_suse': np.linspace(min_val, max_val, bins_suse + 1),
+            'scaled_phi': np.linspace(min_val, max_val, bins_phi + 1),
+            'sim': np.linspace(sim_min, sim_max, bins_suse + 1),
+            'obs': np.linspace(obs_min, obs_max, bins_suse + 1),
+        }
+        hist = {
+            'scaled_suse': np.zeros((2, bins_suse), dtype=np.int64),
+            'scaled_phi': np.zeros((2, bins_phi), dtype=np.int64),
+            'sim': np.zeros(bins_suse, dtype=np.int64),
+            'obs': np.zeros(bins_suse, dtype=np.int64),
+        }
+        dft = np.zeros((2, 0 if freq_idx is None else len(freq_idx)), dtype=complex)
+        abs_sum = np.zeros(2)
+        position = 0
+        for sim, obs in chunks():
+            sim, obs = self._clean(sim, obs)
+            if min_val < max_val:
+                for key in ['scaled_suse', 'scaled_phi']:
+                    hist[key][0] += np.histogram(sim, bins=edges[key])[0]
+                    hist[key][1] += np.histogram(obs, bins=edges[key])[0]
+                if sim_min < sim_max:
+                    hist['sim'] += np.histogram(sim, bins=edges['sim'])[0]
+                if obs_min < obs_max:
+                    hist['obs'] += np.histogram(obs, bins=edges['obs'])[0]
+            if freq_idx is not None:
+                rows = np.vstack([sim, obs]) if freq_band is not None else sim[None, :]
+                dft[:len(rows)] += _band_dft(rows, freq_idx, n, position)
+                abs_sum[:len(rows)] += np.sum(np.abs(rows), axis=1)
+            position += len(sim)
+
+        # Components
+        if phase:
+            if freq_band is not None:
+                in_band = np.isin(freq_idx, band_idx)
+                best = freq_idx[in_band][np.argmax(np.abs(dft[1, in_band]))]
+                best = np.searchsorted(freq_idx, max(best, 34) if n > 365 else best)
+                phase_sim, phase_obs = _dft_angle(dft[:, best].real, dft[:, best].imag, abs_sum)
+            else:
+                phase_sim = _dft_angle(dft[0, 0].real, dft[0, 0].imag, abs_sum[0])
+            phase_difference = (phase_sim - phase_obs + np.pi) % (2 * np.pi) - np.pi
+        else:
+            phase_difference = None
+
+        if min_val == max_val:
+            suse, phi = 0.0, 1.0
+        else:
+            entropy = _row_entropy(np.vstack([hist['scaled_suse'], hist['sim'], hist['obs']]))
+            suse = max(abs(entropy[0] - entropy[1]), abs(entropy[2] - entropy[3]))
+            phi = np.sum(np.minimum(*hist['scaled_phi'])) / np.sum(hist['scaled_phi'][1])
+
+        result = _batch_components(nmaep, phase_difference, suse, phi, c)
+        return pd.Series({name: float(value) for name, value in zip(MFM_COMPONENTS, result)})
+
+    @staticmethod
+    def _clean(sim, obs):
+        """Drop the samples where sim or obs is not finite"""
+        sim = np.asarray(sim, dtype=float)
+        obs = np.asarray(obs, dtype=float)
+        mask = np.isfinite(sim) & np.isfinite(obs)
+        if mask.all():
+            return sim, obs
+        return sim[mask], obs[mask]
+
+    @staticmethod
+    def _dominant_freq_idx(amplitude, n):
+        """Dominant DFT index from the obs amplitudes of bins 1..n // 2, as in PPF_component"""
+        if n > 365:
+            return max(int(np.argmax(amplitude)), 33) + 1
+        return int(np.argmax(amplitude)) + 1
@@ -0,0 +1,125 @@
+"""
+This script evaluates MFM over grids of the hyperparameters p, bins_suse, bins_phi and c.
+
+Work that does not depend on a hyperparameter is done once per site: masking, sorting, the absolute errors
+and the phase difference. Each distinct p, bins_suse and bins_phi value is then computed once, and the grid is
+assembled by broadcasting: p only changes the error norm, the bin counts only change the histograms, and c
+only rescales the cosine of the phase difference.
+"""
+
+import itertools
+import os
+import numpy as np
+import pandas as pd
+from mfm_core import _prepare_batch, _batch_nmaep, _batch_suse, _batch_phi, _batch_components
+
+# Hyperparameter values of the case 5 sensitivity study, one column each (see the tick labels in case5.py)
+CASE_5_GRID = {
+    'p': [round(1.0 + i / 10, 1) for i in range(11)],
+    'bins_suse': list(range(5, 105, 5)),
+    'bins_phi': list(range(5, 105, 5)),
+    'c': [float(i) for i in range(2, 11)],
+}
+
+HYPERPARAMETERS = ['p', 'bins_suse', 'bins_phi', 'c']
+
+
+class sweep:
+    def __init__(self, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, chunk_size=256):
+        """Default hyperparameters are used for every parameter that is not swept"""
+        self.defaults = {'p': p, 'bins_suse': bins_suse, 'bins_phi': bins_phi, 'c': c}
+        self.phase = phase
+        self.chunk_size = chunk_size
+
+        np.seterr(all='ignore')
+
+    def _prepared_chunks(self, sim, obs):
+        """Yield (start, stop, state) for blocks of sites, preparing each block once"""
+        sim = np.atleast_2d(np.asarray(sim, dtype=float))
+        obs = np.atleast_2d(np.asarray(obs, dtype=float))
+        if sim.shape != obs.shape or sim.ndim != 2:
+            raise ValueError(f'sim and obs must be 2-D arrays of the same shape, got {sim.shape} and {obs.shape}')
+        for start in range(0, sim.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, sim.shape[0])
+            yield start, stop, _prepare_batch(sim[start:stop], obs[start:stop], self.phase)
+
+    def _grid_values(self, state, p, bins_suse, bins_phi, c):
+        """MFM of the prepared rows, shaped (n_rows, len(p), len(bins_suse), len(bins_phi), len(c))"""
+        nmaep = np.stack([_batch_nmaep(state, v) for v in p], axis=1)[:, :, None, None, None]
+        suse = np.stack([_batch_suse(state, v) for v in bins_suse], axis=1)[:, None, :, None, None]
+        phi = np.stack([_batch_phi(state, v) for v in bins_phi], axis=1)[:, None, None, :, None]
+        c = np.asarray(c, dtype=float)[None, None, None, None, :]
+        phase_difference = state['phase_difference']
+        if phase_difference is not None:
+            phase_difference = phase_difference[:, None, None, None, None]
+        return _batch_components(nmaep, phase_difference, suse, phi, c)[0]
+
+    def _grid_array(self, sim, obs, grid):
+        """MFM over the Cartesian product of `grid`, shaped (n_sites, n_settings)"""
+        values = [list(grid[name]) for name in HYPERPARAMETERS]
+        n_settings = int(np.prod([len(v) for v in values]))
+        n_sites = np.atleast_2d(np.asarray(sim)).shape[0]
+        result = np.full((n_sites, n_settings), np.nan)
+        for start, stop, state in self._prepared_chunks(sim, obs):
+            if state is not None:
+                result[start + state['good']] = self._grid_values(state, *values).reshape(len(state['good']), -1)
+        return result
+
+    def grid(self, sim, obs, p=None, bins_suse=None, bins_phi=None, c=None):
+        """Calculate MFM of every site for every combination of the given hyperparameter values
+
+        Each argument is a list of values; parameters left as None stay at their default. Returns a DataFrame
+        with one row per site of (n_sites, n_time) sim and obs, and one column per setting, indexed by a
+        (p, bins_suse, bins_phi, c) MultiIndex.
+        """
+        grid = {name: self.defaults[name] if values is None else values
+                for name, values in zip(HYPERPARAMETERS, [p, bins_suse, bins_phi, c])}
+        grid = {name: np.atleast_1d(values).tolist() for name, values in grid.items()}
+        columns = pd.MultiIndex.from_tuples(list(itertools.product(*grid.values())), names=HYPERPARAMETERS)
+        return pd.DataFrame(self._grid_array(sim, obs, grid), columns=columns)
+
+    def sensitivity(self, sim, obs, grid=CASE_5_GRID):
+        """Vary one hyperparameter at a time, keeping the others at their defaults
+
+        Returns a dict of DataFrames, one per swept parameter, with one row per site and one column per value.
+        Sites are prepared once and shared by all parameters.
+        """
+        result = {name: np.full((np.atleast_2d(np.asarray(sim)).shape[0], len(values)), np.nan)
+                  for name, values in grid.items()}
+        for start, stop, state in self._prepared_chunks(sim, obs):
+            if state is None:
+                continue
+            for name, values in grid.items():
+                settings = [list(values) if other == name else [self.defaults[other]] for other in HYPERPARAMETERS]
+                result[name][start + state['good']] = self._grid_values(state, *settings).reshape(
+                    len(state['good']), -1)
+
+        return {name: pd.DataFrame(result[name], columns=list(grid[name])) for name in grid}
+
+    @staticmethod
+    def check_sensitivity(result, path='data/case_5_sensitivity_{}.txt'):
+        """Raise ValueError unless every table has as many columns as the existing file it would replace"""
+        for name, table in result.items():
+            file_path = path.format(name)
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path) as f:
+                n_columns = len(f.readline().split('\t'))
+            if np.shape(table)[1] != n_columns:
+                raise ValueError(f'{name} has {np.shape(table)[1]} values, {file_path} has {n_columns}')
+
+    def write_sensitivity(self, result, path='data/case_5_sensitivity_{}.txt'):
+        """Write `sensitivity` results in the tab-separated case 5 layout (one site per line, no header)
+
+        The layout is checked against the files already at `path` first, as case5.py reads them.
+        """
+        self.check_sensitivity(result, path)
+        for name, table in result.items():
+            file_path = path.format(name)
+            print(f'\033[1;31mSaving {file_path}...\033[0m')
+            with open(file_path, 'w') as f:
+                for row in np.asarray(table):
+                    f.write('\t'.join(repr(float(v)) for v in row) + '\n')
+        print('\033[1;31mDone.\033[0m')
+
+        return 0
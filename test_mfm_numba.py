@@ -0,0 +1,72 @@
+"""
+This script checks the Numba kernels of `mfm_numba` against the NumPy reference (python -m pytest).
+
+The compiled kernels stay opt-in (`mfm(backend='numba')`) until these tests pass; without Numba they are skipped.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+from mfm import mfm
+from mfm_core import MFM_COMPONENTS, BASELINE_COMPONENTS
+from mfm_numba import resolve_backend, check_parity, _parity_cases, _mfm_batch_numba, _baseline_batch_numba
+
+PARAMS = [{}, dict(p=2, bins_suse=15, bins_phi=20, c=3), dict(phase=False)]
+DTYPES = [(np.float64, 1e-9), (np.float32, 1e-5)]
+
+
+@pytest.fixture(scope='module')
+def cases():
+    return _parity_cases(seed=0)
+
+
+def test_auto_resolves_to_numba():
+    assert resolve_backend('auto') == 'numba'
+    assert mfm().backend == 'numpy'
+
+
+@pytest.mark.parametrize('dtype, tolerance', DTYPES)
+@pytest.mark.parametrize('params', PARAMS, ids=repr)
+def test_mfm_rows(cases, dtype, tolerance, params):
+    sim, obs = (values.astype(dtype) for values in cases)
+    params = {'p': 1, 'bins_suse': 10, 'bins_phi': 10, 'c': 4, 'phase': True, **params}
+    reference = mfm(backend='numpy')
+    expected = np.array([reference.model_fidelity_metric(s, o, return_type='tuple', **params)
+                         for s, o in zip(sim, obs)])
+    actual = _mfm_batch_numba(sim, obs, **params)
+    for j, component in enumerate(MFM_COMPONENTS):
+        np.testing.assert_allclose(actual[:, j], expected[:, j], rtol=0, atol=tolerance, equal_nan=True,
+                                   err_msg=component)
+
+
+@pytest.mark.parametrize('dtype, tolerance', DTYPES)
+def test_baseline_rows(cases, dtype, tolerance):
+    sim, obs = (values.astype(dtype) for values in cases)
+    reference = mfm(backend='numpy')
+    expected = np.array([reference.baseline_metrics(s, o, return_type='tuple') for s, o in zip(sim, obs)])
+    actual = _baseline_batch_numba(sim, obs)
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    difference = np.abs(actual - expected) / np.maximum(np.abs(expected), 1.0)
+    for j, component in enumerate(BASELINE_COMPONENTS):
+        assert np.nanmax(difference[:, j], initial=0.0) <= tolerance, component
+
+
+def test_batch_backends_agree(cases):
+    sim, obs = cases
+    numpy_mfm = mfm(backend='numpy').model_fidelity_metric_batch(sim, obs)
+    numba_mfm = mfm(backend='numba').model_fidelity_metric_batch(sim, obs)
+    np.testing.assert_allclose(numba_mfm.to_numpy(), numpy_mfm.to_numpy(), rtol=0, atol=1e-9, equal_nan=True)
+    numpy_baseline = mfm(backend='numpy').baseline_metrics_batch(sim, obs).to_numpy()
+    numba_baseline = mfm(backend='numba').baseline_metrics_batch(sim, obs).to_numpy()
+    # Relative to max(|value|, 1), as in test_baseline_rows: near-zero values (e.g. the obs mean of a centred
+    # series) are rounding noise on both sides
+    np.testing.assert_array_equal(np.isnan(numba_baseline), np.isnan(numpy_baseline))
+    difference = np.abs(numba_baseline - numpy_baseline) / np.maximum(np.abs(numpy_baseline), 1.0)
+    assert np.nanmax(difference, initial=0.0) <= 1e-9
+
+
+def test_check_parity():
+    table, passed = check_parity()
+    assert passed, table[~table['passed']].to_string()
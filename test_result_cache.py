@@ -0,0 +1,55 @@
+"""
+This script checks that cached metric results match uncached ones, whichever path stored them (python -m pytest).
+
+The single and batch paths agree to rounding, so results are compared within 1e-12.
+"""
+
+import numpy as np
+import pytest
+from mfm import mfm
+from mfm_core import MFM_COMPONENTS, BASELINE_COMPONENTS
+from result_cache import result_cache
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(0)
+    obs = rng.gamma(0.8, 1.0, (3, 400))
+    sim = obs * 1.1 + rng.normal(0, 0.1, obs.shape)
+    sim[1] = np.nan  # a row without finite pairs
+    return sim, obs
+
+
+def test_batch_then_single(tmp_path, series):
+    sim, obs = series
+    cached = mfm(cache=result_cache(str(tmp_path / 'cache.sqlite')))
+    reference = mfm()
+    cached.model_fidelity_metric_batch(sim, obs)
+    cached.baseline_metrics_batch(sim, obs)
+    for s, o in zip(sim, obs):
+        np.testing.assert_allclose(cached.model_fidelity_metric(s, o, return_type='tuple'),
+                                   reference.model_fidelity_metric(s, o, return_type='tuple'), rtol=0, atol=1e-12)
+        np.testing.assert_allclose(cached.baseline_metrics(s, o, return_type='tuple'),
+                                   reference.baseline_metrics(s, o, return_type='tuple'), rtol=1e-12)
+
+
+def test_single_then_batch(tmp_path, series):
+    sim, obs = series
+    cached = mfm(cache=result_cache(str(tmp_path / 'cache.sqlite')))
+    for s, o in zip(sim, obs):
+        cached.model_fidelity_metric(s, o)
+        cached.baseline_metrics(s, o)
+    reference = mfm()
+    np.testing.assert_allclose(cached.model_fidelity_metric_batch(sim, obs)[MFM_COMPONENTS].to_numpy(),
+                               reference.model_fidelity_metric_batch(sim, obs)[MFM_COMPONENTS].to_numpy(),
+                               rtol=0, atol=1e-12)
+    np.testing.assert_allclose(cached.baseline_metrics_batch(sim, obs)[BASELINE_COMPONENTS].to_numpy(),
+                               reference.baseline_metrics_batch(sim, obs)[BASELINE_COMPONENTS].to_numpy(),
+                               rtol=1e-12)
+
+
+def test_backends_keyed_apart(series):
+    sim, obs = series
+    numpy_key = result_cache.key('mfm', sim[0], obs[0], (1, 10, 10, 4, True))
+    assert numpy_key == result_cache.key('mfm', sim[0], obs[0], (1, 10, 10, 4, True), 'numpy')
+    assert numpy_key != result_cache.key('mfm', sim[0], obs[0], (1, 10, 10, 4, True), 'numba')
@@ -0,0 +1,129 @@
+"""
+This script estimates the sampling uncertainty of MFM and the baseline metrics (case 4 table).
+
+Water years are resampled as blocks: a leave-one-year-out jackknife, a block bootstrap, and the
+jackknife-after-bootstrap standard error of the bootstrap standard error. Replicates are built as padded
+index arrays and scored in batches through the vectorized metric kernels, so the padding is simply masked
+like missing data.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from mfm_core import BASELINE_COMPONENTS, water_years, _block_layout, _replicate_indices, _mfm_batch, _baseline_batch
+
+# Metrics of the case 4 table, in its row order
+GOF_STATS = ['NSE', 'KGE', 'mKGE', 'MFM', 'RMSE', 'NRMSE']
+
+RESULT_COLUMNS = ['CAMELS_site', 'lat', 'lon', 'GOF_stat', 'seJack', 'seBoot', 'p05', 'p50', 'p95', 'score',
+                  'biasJack', 'biasBoot', 'seJab', 'cor']
+
+_BASELINE_TAKE = [BASELINE_COMPONENTS.index(stat) for stat in ['NSE', 'KGE', 'mKGE', 'RMSE', 'NRMSE']]
+
+
+def _site_task(args):
+    """Process-pool entry point: uncertainty statistics of one site"""
+    engine, site_index, sim, obs, blocks = args
+    return engine.site_statistics(sim, obs, blocks, np.random.SeedSequence(engine.seed, spawn_key=(site_index,)))
+
+
+class uncertainty:
+    def __init__(self, n_boot=1000, seed=0, p=1, bins_suse=10, bins_phi=10, c=4, phase=True, chunk_size=128):
+        self.n_boot = n_boot
+        self.seed = seed
+        self.mfm_kwargs = {'p': p, 'bins_suse': bins_suse, 'bins_phi': bins_phi, 'c': c, 'phase': phase}
+        self.chunk_size = chunk_size
+
+        np.seterr(all='ignore')
+
+    def scores(self, sim, obs):
+        """GOF_STATS and the correlation of each row of 2-D sim and obs arrays"""
+        baseline = _baseline_batch(sim, obs)
+        scores = np.column_stack([baseline[:, _BASELINE_TAKE[:3]],
+                                  _mfm_batch(sim, obs, **self.mfm_kwargs)[:, 0],
+                                  baseline[:, _BASELINE_TAKE[3:]]])
+        return scores, baseline[:, BASELINE_COMPONENTS.index('rprod')]
+
+    def replicate_scores(self, sim, obs, choice, layout):
+        """GOF_STATS of the replicates given by rows of block choices, built and scored chunk by chunk"""
+        result = np.empty((len(choice), len(GOF_STATS)))
+        for start in range(0, len(choice), self.chunk_size):
+            index = _replicate_indices(choice[start:start + self.chunk_size], *layout)
+            padding = index < 0
+            sim_rep = np.where(padding, np.nan, sim[index])
+            obs_rep = np.where(padding, np.nan, obs[index])
+            result[start:start + self.chunk_size] = self.scores(sim_rep, obs_rep)[0]
+        return result
+
+    def site_statistics(self, sim, obs, blocks, seed_sequence=None):
+        """Calculate the jackknife and bootstrap statistics of every metric for one site
+
+        `blocks` labels the resampling block of each day, usually `water_years(year, month)`. Returns a
+        DataFrame indexed by GOF_stat with the statistic columns of the case 4 table.
+
+        Against the shipped data/case_4_mfm.txt, scores agree to rounding and seJack agrees to about 0.1% for
+        NSE, KGE, mKGE, RMSE and NRMSE. MFM seJack differs by 0.04% to 12% across the sample sites (0.01793
+        against 0.01742 at 01013500), and biasJack and seJab differ for every metric: the replicate
+        construction behind the published table is not recoverable from the data.
+        """
+        sim = np.asarray(sim, dtype=float)
+        obs = np.asarray(obs, dtype=float)
+        layout = _block_layout(np.asarray(blocks))
+        n_blocks = len(layout[1])
+
+        score, cor = self.scores(sim[None], obs[None])
+        score = score[0]
+
+        # Leave-one-block-out jackknife
+        every_block = np.arange(n_blocks)
+        jack_choice = np.array([np.delete(every_block, i) for i in every_block])
+        jack = self.replicate_scores(sim, obs, jack_choice, layout)
+        jack_mean = np.nanmean(jack, axis=0)
+        seJack = np.sqrt((n_blocks - 1) / n_blocks * np.nansum((jack - jack_mean) ** 2, axis=0))
+        biasJack = (n_blocks - 1) * (jack_mean - score)
+
+        # Block bootstrap
+        rng = np.random.default_rng(seed_sequence if seed_sequence is not None else self.seed)
+        boot_choice = rng.integers(0, n_blocks, size=(self.n_boot, n_blocks))
+        boot = self.replicate_scores(sim, obs, boot_choice, layout)
+        seBoot = np.nanstd(boot, axis=0, ddof=1)
+        p05, p50, p95 = np.nanpercentile(boot, [5, 50, 95], axis=0)
+        biasBoot = np.nanmean(boot, axis=0) - score
+
+        # Jackknife-after-bootstrap: spread of the bootstrap SE over replicates that never drew each block
+        drawn = np.zeros((self.n_boot, n_blocks), dtype=bool)
+        drawn[np.arange(self.n_boot)[:, None], boot_choice] = True
+        se_without = np.array([np.nanstd(boot[~drawn[:, i]], axis=0, ddof=1) for i in every_block])
+        seJab = np.sqrt((n_blocks - 1) / n_blocks *
+                        np.nansum((se_without - np.nanmean(se_without, axis=0)) ** 2, axis=0))
+
+        return pd.DataFrame({
+            'seJack': seJack, 'seBoot': seBoot, 'p05': p05, 'p50': p50, 'p95': p95, 'score': score,
+            'biasJack': biasJack, 'biasBoot': biasBoot, 'seJab': seJab, 'cor': cor[0],
+        }, index=pd.Index(GOF_STATS, name='GOF_stat'))
+
+    def evaluate(self, flows, sites, lat=None, lon=None, workers=1):
+        """Build the case 4 uncertainty table for many sites
+
+        `flows` are `read_file.read_flow` tables (year, month, day, sim, obs), one per entry of `sites`.
+        Each site draws from its own seeded stream, so the table does not depend on `workers`.
+        """
+        tasks = [(self, i, flow['sim'].to_numpy(float), flow['obs'].to_numpy(float),
+                  water_years(flow['year'], flow['month'])) for i, flow in enumerate(flows)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                tables = list(pool.map(_site_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+        else:
+            tables = [_site_task(task) for task in tasks]
+
+        lat = [np.nan] * len(tables) if lat is None else lat
+        lon = [np.nan] * len(tables) if lon is None else lon
+        result = pd.concat([table.reset_index().assign(CAMELS_site=site, lat=site_lat, lon=site_lon)
+                            for table, site, site_lat, site_lon in zip(tables, sites, lat, lon)],
+                           ignore_index=True)
+        return result[RESULT_COLUMNS]
+
+    def write_result(self, result, result_path):
+        """Write the table in the tab-separated layout of data/case_4_mfm.txt"""
+        result.to_csv(result_path, sep='\t', index=False)
+        return 0